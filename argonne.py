@@ -1,20 +1,26 @@
 #!/usr/bin/env -S python -u
 import os
+import sys
+import glob
 import time
 from contextlib import contextmanager
 import argparse
+import concurrent.futures
 
 import numpy as np
 import scipy.optimize
 
+import tcitool.calc.argonne_kernels as ak
+
 class ArgonneModel(object):
     def __init__(self,**kwargs):
         self.const = self.constants()
-        self.fn, self.bgfn, self.nwfn = self.functions()
+        self.fn = self.functions()
         self.hyperparams = {
             'Tg_lim': (-60,120),
             'Tnw_lim': (-60,90),
             'xtol': 0.1,
+            'maxiter': 100,
             'daytime': False,
             'no_oob': True
         }
@@ -22,89 +28,76 @@ class ArgonneModel(object):
     def constants(self):
         const = {}
         const['GRAVITY'] = 9.81
-        const['STEFANB'] = 5.67e-8
+        const['STEFANB'] = ak.STEFANB
         const['SOLAR_CONST'] = 1367.
-        const['Cp'] = 1003.5
-        const['M_AIR'] = 28.965
-        const['M_H2O'] = 18.015
-        const['RATIO'] = ( const['Cp']*const['M_AIR']/const['M_H2O'] )
-        const['R_GAS'] = 8314.34
-        const['R_AIR'] = ( const['R_GAS']/const['M_AIR'] )
+        const['Cp'] = ak.Cp
+        const['M_AIR'] = ak.M_AIR
+        const['M_H2O'] = ak.M_H2O
+        const['RATIO'] = ak.RATIO
+        const['R_GAS'] = ak.R_GAS
+        const['R_AIR'] = ak.R_AIR
         # define wick constants
-        const['EMIS_WICK'] = 0.95
-        const['ALB_WICK'] = 0.4
-        const['D_WICK'] = 0.007
-        const['L_WICK'] = 0.0254
+        const['EMIS_WICK'] = ak.EMIS_WICK
+        const['ALB_WICK'] = ak.ALB_WICK
+        const['D_WICK'] = ak.D_WICK
+        const['L_WICK'] = ak.L_WICK
         # define globe constants
-        const['EMIS_GLOBE'] = 0.95
-        const['ALB_GLOBE'] = 0.05
-        const['D_GLOBE'] = 0.0508
+        const['EMIS_GLOBE'] = ak.EMIS_GLOBE
+        const['ALB_GLOBE'] = ak.ALB_GLOBE
+        const['D_GLOBE'] = ak.D_GLOBE
         # define surface constants
-        const['EMIS_SFC'] = 0.999
+        const['EMIS_SFC'] = ak.EMIS_SFC
         # define computational and physical limits
         const['CZA_MIN'] = np.cos(np.deg2rad(87.5))
         const['MIN_SPEED'] = 0.1
         return const
     def functions(self):
-        const = self.const
-        fn = {}
-        fn['tref'] = lambda temp1,temp2: 0.5*(temp1+temp2)
-        fn['esat'] = lambda temp_K: 0.611 * np.exp(17.2694*(temp_K-273.16)/(temp_K-35.86))
-        fn['evap'] = lambda temp_K: (313.15-temp_K)/30*-71100+2.4073e6
-        fn['emis_e'] = lambda e_kPa: 0.575 * np.power(e_kPa,0.143)
-        fn['emis'] = lambda temp_K, rh: fn['emis_e'](rh*fn['esat'](temp_K))
-        fn['dens'] = lambda temp_K, P_kPa: (P_kPa*1e3)/((const['R_GAS']/const['M_AIR'])*temp_K)
-        fn['cond'] = lambda temp_K: 0.02624 * np.power(temp_K/300,0.8646)
-        fn['capp'] = lambda temp_K: 1002.5+275e-6 * np.power(temp_K-200,2)
-        fn['vhca'] = lambda temp_K, P_kPa: fn['dens'](temp_K,P_kPa) * fn['capp'](temp_K)
-        fn['diff'] = lambda temp_K, P_kPa: fn['cond'](temp_K) / fn['vhca'](temp_K,P_kPa)
-        fn['visc'] = lambda temp_K: 1.458e-6*(temp_K**1.5) / (temp_K +110.4)
-        fn['Sc'] = lambda temp_K, P_kPa: fn['visc'](temp_K) / (fn['dens'](temp_K,P_kPa) * fn['diff'](temp_K,P_kPa))
-        fn['Pr'] = lambda temp_K: fn['capp'](temp_K) * fn['visc'](temp_K) / fn['cond'](temp_K)
+        return {
+            'Tg': ak.tg_residual,
+            'Tnw': ak.tnw_residual,
+            'solve_Tg': ak.solve_tg,
+            'solve_Tnw': ak.solve_tnw,
+            'solve_Tg_night': ak.solve_tg_night,
+            'solve_Tnw_night': ak.solve_tnw_night,
+        }
+    def solve(self,data,tg_or_tnw):
+        """Solves Tg or Tnw for all points in data at once
 
-        bgfn = {}
-        bgfn['Re'] = lambda temp_K, P_kPa, ws: \
-            ws * fn['dens'](temp_K,P_kPa) * const['D_GLOBE'] / self.fn['visc'](temp_K)
-        bgfn['Nu'] = lambda temp_K, P_kPa, ws: \
-            2 + 0.6 * np.sqrt(bgfn['Re'](temp_K, P_kPa, ws)) * np.power(fn['Pr'](temp_K),0.3333)
-        bgfn['h'] = lambda temp_K, P_kPa, ws: \
-            bgfn['Nu'](temp_K, P_kPa, ws) * fn['cond'](temp_K) * const['D_GLOBE']
-        bgfn['hs'] = lambda Tg, t2m, P_kPa, ws: bgfn['h'](fn['tref'](Tg, t2m), P_kPa, ws)
-        bgfn['Tg'] = ( lambda Tg, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal:
-            0.5 * fn['emis'](fn['tref'](Tg, t2m),rh) * np.power(t2m,4.)
-            + 0.5 * const['EMIS_SFC'] * np.power(skt,4.)
-            - (bgfn['hs'](Tg,t2m,P_kPa,ws) / (const['STEFANB'] * const['EMIS_GLOBE']) * (Tg - t2m) )
-            + (Isw_in / (2. * const['STEFANB'] * const['EMIS_GLOBE']))
-                * (1. - const['ALB_GLOBE']) * (Isw_frac*(1./(2.*solcza)-1.)+1.+fal) \
-            - np.power(Tg,4) )
+        Args:
+            data: array with the 10 input parameters along axis 0
+            tg_or_tnw: 'Tg' or 'Tnw'
 
-        nwfn = {}
-        nwfn['Fatm'] = ( lambda Tnw, t2m, skt, rh, Isw_in, Isw_frac, solcza, fal:
-            const['STEFANB'] * const['EMIS_WICK'] * (
-                0.5*( fn['emis'](t2m,rh)*np.power(t2m,4.) + const['EMIS_SFC']*np.power(skt,4.))
-                - np.power(Tnw,4.))
-            + (1. - const['ALB_WICK']) * Isw_in * (
-                (1. - Isw_frac) * (1. + 0.25 * const['D_WICK'] / const['L_WICK'])
-                + Isw_frac * ( (np.tan(np.arccos(solcza))/np.pi) + 0.25 * const['D_WICK'] / const['L_WICK'])
-                + fal)
-            )
-        nwfn['Re'] = lambda temp_K, P_kPa, ws: \
-            ws * fn['dens'](temp_K,P_kPa) * const['D_WICK'] / fn['visc'](temp_K)
-        nwfn['Nu'] = lambda temp_K, P_kPa, ws: \
-            0.281 * np.power(nwfn['Re'](temp_K, P_kPa, ws),1-0.4) * np.power(fn['Pr'](temp_K),1-0.56)
-        nwfn['h'] = lambda temp_K, P_kPa, ws: \
-            nwfn['Nu'](temp_K, P_kPa, ws) * fn['cond'](temp_K) / const['D_WICK']
-        nwfn['hc'] = lambda Tnw, t2m, P_kPa, ws: nwfn['h'](fn['tref'](Tnw, t2m), P_kPa, ws)
-        nwfn['wf'] = lambda Tnw, t2m, rh, P_kPa: (fn['esat'](Tnw) - (rh*fn['esat'](t2m)))/(P_kPa - fn['esat'](Tnw))
-        nwfn['Tnw'] = ( lambda Tnw, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal:
-            Tnw - ( t2m - (
-                fn['evap'](fn['tref'](Tnw,t2m))
-                / const['RATIO']
-                * nwfn['wf'](Tnw, t2m, rh, P_kPa)
-                * np.power( fn['Pr'](fn['tref'](Tnw, t2m)) / fn['Sc'](fn['tref'](Tnw, t2m),P_kPa),0.56)
-                + ( nwfn['Fatm'](Tnw,t2m,skt,rh,Isw_in,Isw_frac,solcza,fal) / nwfn['hc'](Tnw, t2m, P_kPa, ws) )
-            ) ) )
-        return fn, bgfn, nwfn
+        Returns:
+            An array of data.shape[1:]. Points without a solution are NaN, or
+            raise a ValueError if the no_oob hyperparameter is False.
+        """
+        param_list = ['t2m','skt','rh','e_kPa','P_kPa','ws','Isw_in','Isw_frac','solcza','fal']
+        data = np.asarray(data)
+        if data.shape[0] < len(param_list):
+            raise ValueError('Not enough parameters')
+        params = tuple(data[-len(param_list):])
+        lim = self.hyperparams[tg_or_tnw+'_lim']
+        result = np.full(params[0].shape,np.nan)
+        skip = np.zeros(result.shape,dtype=bool)
+        if self.hyperparams['daytime']:
+            skip = ((params[6]<=1) | #Isw_in
+                    (params[7]<=0.01) | #Isw_frac
+                    (params[8]<=self.const['CZA_MIN'])) #solcza
+        night = ~skip & (params[6]<=0) #Isw_in
+        day = ~skip & ~night
+        for mask, solver, nparams in ((night,'solve_%s_night',6),
+                                      (day,'solve_%s',len(param_list))):
+            if mask.any():
+                result[mask] = self.fn[solver%tg_or_tnw](
+                    lim[0]+273.15, lim[1]+273.15,
+                    self.hyperparams['xtol'], self.hyperparams['maxiter'],
+                    *(param[mask] for param in params[:nparams]))
+        if not self.hyperparams['no_oob']:
+            unsolved = np.argwhere(np.isnan(result) & ~skip)
+            if unsolved.size > 0:
+                point = (slice(None),)+tuple(unsolved[0])
+                raise self.errormessage(ValueError(),tg_or_tnw,zip(param_list,data[point]))
+        return result
     def optimize_globe_temperature(self,params):
         param_list = ['t2m','skt','rh','e_kPa','P_kPa','ws','Isw_in','Isw_frac','solcza','fal']
         params_tuple = tuple(params)[-len(param_list):]
@@ -118,13 +111,13 @@ class ArgonneModel(object):
         if len(params_tuple)<len(param_list):
             raise ValueError('Not enough parameters')
         if self.hyperparams['no_oob']:
-            a = self.bgfn['Tg'](self.hyperparams['Tg_lim'][0]+273.15,*params_tuple)
-            b = self.bgfn['Tg'](self.hyperparams['Tg_lim'][1]+273.15,*params_tuple)
+            a = self.fn['Tg'](self.hyperparams['Tg_lim'][0]+273.15,*params_tuple)
+            b = self.fn['Tg'](self.hyperparams['Tg_lim'][1]+273.15,*params_tuple)
             if np.sign(a)==np.sign(b):
                 return np.nan
         try:
             tg = scipy.optimize.brentq(
-                f=self.bgfn['Tg'],
+                f=self.fn['Tg'],
                 a=self.hyperparams['Tg_lim'][0]+273.15,
                 b=self.hyperparams['Tg_lim'][1]+273.15,
                 xtol=self.hyperparams['xtol'],
@@ -149,13 +142,13 @@ class ArgonneModel(object):
         if len(params_tuple)<len(param_list):
             raise ValueError('Not enough parameters')
         if self.hyperparams['no_oob']:
-            a = self.nwfn['Tnw'](self.hyperparams['Tnw_lim'][0]+273.15,*params_tuple)
-            b = self.nwfn['Tnw'](self.hyperparams['Tnw_lim'][1]+273.15,*params_tuple)
+            a = self.fn['Tnw'](self.hyperparams['Tnw_lim'][0]+273.15,*params_tuple)
+            b = self.fn['Tnw'](self.hyperparams['Tnw_lim'][1]+273.15,*params_tuple)
             if np.sign(a)==np.sign(b):
                 return np.nan
         try:
             tnw = scipy.optimize.brentq(
-                f=self.nwfn['Tnw'],
+                f=self.fn['Tnw'],
                 a=self.hyperparams['Tnw_lim'][0]+273.15,
                 b=self.hyperparams['Tnw_lim'][1]+273.15,
                 xtol=self.hyperparams['xtol'],
@@ -181,10 +174,10 @@ class ArgonneModel(object):
         olist = []
         if tg_or_tnw=='Tg':
             for t in range(self.hyperparams['Tg_lim'][0],self.hyperparams['Tg_lim'][1],10):
-                olist.append('    %d: %f'%( t,self.bgfn['Tg'](t+273.15,*tuple(param.values())) ))
+                olist.append('    %d: %f'%( t,self.fn['Tg'](t+273.15,*tuple(param.values())) ))
         elif tg_or_tnw=='Tnw':
             for t in range(self.hyperparams['Tnw_lim'][0],self.hyperparams['Tnw_lim'][1],10):
-                olist.append('    %d: %f'%( t,self.nwfn['Tnw'](t+273.15,*tuple(param.values())) ))
+                olist.append('    %d: %f'%( t,self.fn['Tnw'](t+273.15,*tuple(param.values())) ))
         return ValueError(msg+'\n'.join(olist))
 
 @contextmanager
@@ -200,26 +193,112 @@ def vp(verbose,msg,**kwargs):
     if verbose:
     	print(msg,**kwargs)
 
-def main(infile,outfile,verbose=True,pid=''):
+def main(infile,outfile,verbose=True,pid='',model=None,index=None):
+    """Solves Tg and Tnw for the input array in infile, and saves them to
+    outfile. When index (a slice) is given, only input[:,index] is solved,
+    and the results are written in place into output[:,index] of the
+    existing outfile (see Tool.wbgt_argonne_external)."""
     vp(verbose,'[%s ] Starting. Using %s as data'%(pid,infile),flush=True)
-    model = ArgonneModel()
+    if model is None:
+        model = ArgonneModel()
     data = np.load(infile,mmap_mode='r')
+    if index is not None:
+        data = data[:,index]
     datasize = format(data.size//10,',d').replace(',',' ')
     with timeit(
             premsg='[%sw] Calculating %s natural wetbulb temperatures...'%(pid,datasize),
             postmsg='[%sw] Done,'%(pid),
             verbose=verbose):
-        tnwa = np.apply_along_axis(func1d=model.optimize_natural_wetbulb_temperature,axis=0,arr=data)
+        tnwa = model.solve(data,'Tnw')
     with timeit(
             premsg='[%sg] Calculating %s globe temperatures... '%(pid,datasize),
             postmsg='[%sg] Done,'%(pid),
             verbose=verbose):
-    	tga = np.apply_along_axis(func1d=model.optimize_globe_temperature,axis=0,arr=data)
-    outdata = np.stack([tga,tnwa],axis=0)
-    np.save(outfile,outdata)
-    del data, datasize, tga, tnwa, outdata, model
+        tga = model.solve(data,'Tg')
+    if index is None:
+        np.save(outfile,np.stack([tga,tnwa],axis=0))
+    else:
+        outdata = np.load(outfile,mmap_mode='r+')
+        outdata[0,index] = tga
+        outdata[1,index] = tnwa
+        outdata.flush()
+        del outdata
+    del data, datasize, tga, tnwa
     vp(verbose,'[%s ] Stored output to %s'%(pid,outfile),flush=True)
 
+def parse_range(arg):
+    """Parses 'start:stop' into a slice"""
+    start, stop = arg.split(':')
+    return slice(int(start),int(stop))
+
+def read_jobs(lines):
+    """Reads jobs from lines of 'infile outfile [pid [start:stop]]'. Empty
+    lines and lines starting with # are skipped."""
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) < 2:
+            raise ValueError('Expected "infile outfile [pid]", got "%s"'%line)
+        pid = fields[2] if len(fields) > 2 else os.path.splitext(
+            os.path.basename(fields[0]))[0]
+        index = parse_range(fields[3]) if len(fields) > 3 else None
+        jobs.append((fields[0],fields[1],pid,index))
+    return jobs
+
+def directory_jobs(folder,outfolder=None):
+    """Creates a job for every time step of folder/input.npy (written in place
+    to folder/output.npy), or else for every inp/*.npy in folder (or *.npy,
+    if there is no inp directory), writing to the file with the same name in
+    outfolder (default: folder/out)."""
+    inpfile = os.path.join(folder,'input.npy')
+    outfile = os.path.join(folder,'output.npy')
+    if os.path.isfile(inpfile) and os.path.isfile(outfile):
+        ntime = np.load(inpfile,mmap_mode='r').shape[1]
+        return [(inpfile,outfile,'%04d'%i,slice(i,i+1))
+                for i in range(ntime)]
+    inpfolder = os.path.join(folder,'inp')
+    if not os.path.isdir(inpfolder):
+        inpfolder = folder
+    if outfolder is None:
+        outfolder = os.path.join(folder,'out')
+    os.makedirs(outfolder,exist_ok=True)
+    return [(infile,
+             os.path.join(outfolder,os.path.basename(infile)),
+             os.path.splitext(os.path.basename(infile))[0],
+             None)
+            for infile in sorted(glob.glob(os.path.join(inpfolder,'*.npy')))]
+
+_batch_model = None
+def _init_batch_worker():
+    global _batch_model
+    _batch_model = ArgonneModel()
+
+def _run_batch_job(job,verbose):
+    infile, outfile, pid, index = job
+    main(infile,outfile,verbose,pid,model=_batch_model,index=index)
+    return job
+
+def batch(jobs,workers=1,verbose=True):
+    """Runs main for every (infile, outfile, pid, index) in jobs, in this
+    process or in a pool of workers. Every process creates a single
+    ArgonneModel."""
+    vp(verbose,'[batch] Running %d shards using %d worker(s)'%(
+        len(jobs),workers),flush=True)
+    if workers <= 1:
+        model = ArgonneModel()
+        for infile, outfile, pid, index in jobs:
+            main(infile,outfile,verbose,pid,model=model,index=index)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,initializer=_init_batch_worker) as executor:
+        futures = [executor.submit(_run_batch_job,job,verbose)
+                   for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
 def is_valid_input_file(parser,arg):
     if not os.path.isfile(arg):
         parser.error("The file %s does not exist!"%arg)
@@ -228,6 +307,12 @@ def is_valid_input_file(parser,arg):
     else:
         return arg
 
+def is_valid_directory(parser,arg):
+    if not os.path.isdir(arg):
+        parser.error("The directory %s does not exist!"%arg)
+    else:
+        return arg
+
 def is_valid_output_file(parser,arg):
     dirname = os.path.dirname(arg)
     if not os.path.isdir(dirname):
@@ -238,19 +323,50 @@ def is_valid_output_file(parser,arg):
         return arg
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Run the Argonne model on a Numpy Array file (*.npy).')
-    parser.add_argument('-i', dest='inputfilename', required=True,
+    parser = argparse.ArgumentParser(description='Run the Argonne model on a Numpy Array file (*.npy), or on many files in one process.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-i', dest='inputfilename',
         type=lambda x: is_valid_input_file(parser, x),
         help='The input array as *.npy\n'
         'Different input variables need to be in the first dimension (axis=0) and the order '
         '2m temp, surface temp, rel hum, vapor pressure, pressure, 2m wind speed, global radiation, '
         'fraction direct/global radiation, cosine of solar zenith angle, albedo')
-    parser.add_argument('-o', dest='outputfilename', required=True,
-        type=lambda x: is_valid_output_file(parser, x),
+    source.add_argument('-m', dest='manifest',
+        help='Batch mode: a text file with a line "infile outfile [pid [start:stop]]" per shard')
+    source.add_argument('-d', dest='directory',
+        type=lambda x: is_valid_directory(parser, x),
+        help='Batch mode: a directory with input shards (in DIR/inp/*.npy, or DIR/*.npy). '
+        'Outputs are written with the same name to DIR/out, or to the directory given by -o')
+    source.add_argument('--stdin', dest='stdin', action='store_true',
+        help='Batch mode: read lines "infile outfile [pid [start:stop]]" from stdin')
+    parser.add_argument('-o', dest='outputfilename',
         help='The output array as *.npy\n'
         'Different output variables will be in the first dimension (axis=0) and the order '
         'Globe temperature (5cm globe), Natural wet bulb temperature')
+    parser.add_argument('-r', dest='range', type=parse_range,
+        help='Only solve the time steps start:stop (axis=1) of the input, and write them '
+        'in place into the existing output array')
+    parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Batch mode: number of worker processes')
     parser.add_argument('-p', dest='pid', help='String to separate the output from this script, from others', action='store')
     parser.add_argument('-v', dest='verbose', help='Print more data', action='store_true')
     args = parser.parse_args()
-    main(args.inputfilename,args.outputfilename,True,args.pid)
+    if args.inputfilename is not None:
+        if args.outputfilename is None:
+            parser.error('-o is required together with -i')
+        if args.range is not None and not os.path.isfile(args.outputfilename):
+            parser.error("The file %s does not exist!"%args.outputfilename)
+        main(args.inputfilename,
+             is_valid_output_file(parser,args.outputfilename),
+             True,args.pid,index=args.range)
+    else:
+        if args.directory is not None:
+            jobs = directory_jobs(args.directory,args.outputfilename)
+        elif args.stdin:
+            jobs = read_jobs(sys.stdin)
+        else:
+            if not os.path.isfile(args.manifest):
+                parser.error("The file %s does not exist!"%args.manifest)
+            with open(args.manifest) as fh:
+                jobs = read_jobs(fh)
+        batch(jobs,args.workers,args.verbose)
@@ -2,6 +2,7 @@ import tcitool.cm as cm
 
 from tcitool.exc import MissingDataError
 from tcitool.exc import UnknownCalculatorWarning
+from tcitool.exc import SolverWarning
 
 from tcitool.data import DataStore
 
@@ -14,6 +15,7 @@ from tcitool.gens.common import IntegratedVarsGenerators
 from tcitool.gens.solar import SolarGenerators
 from tcitool.gens.harmonie import HarmonieGenerators
 
+from tcitool.calc.solver import ArrayRootFinder
 from tcitool.calc.calculator import Calculator
 from tcitool.calc.calculator import OptimizationCalculator
 from tcitool.calc.wbgt_approx import WBGTapprox_ACSMCalculator
@@ -21,6 +23,8 @@ from tcitool.calc.wbgt_approx import WBGTapprox_BernardCalculator
 from tcitool.calc.wbgt_approx import WBGTapprox_DimiceliCalculator
 from tcitool.calc.wbgt_approx import WBGTapprox_GommersCalculator
 from tcitool.calc.wbgt_argonne import WBGT_ArgonneCalculator
+from tcitool.calc.wbgt_argonne_lut import ArgonneLookupTable
+from tcitool.calc.wbgt_argonne_lut import WBGT_ArgonneLUTCalculator
 from tcitool.calc.windchill import WindChill_JAGTICalculator
 
 from tcitool.tool import *
@@ -0,0 +1,138 @@
+"""Fused kernels of the approximation formulas.
+
+These kernels are used by the WBGTapprox_* calculators and
+tcitool.WindChill_JAGTICalculator. Every kernel evaluates its formula in one
+pass over numpy arrays, without a full-size temporary for every operation.
+
+When numexpr is installed, the formulas are compiled by numexpr, which
+evaluates them blockwise (in cache sized blocks) on all cores. Without
+numexpr, the same formulas are evaluated as numpy expressions in Horner form,
+with the shared subexpressions computed once and the operations done in place.
+
+The kernels return an array of the dtype of their inputs (e.g. float32, see
+Tool.compute_dtype). apply runs a kernel on DataArrays, chunk by chunk when
+they are dask arrays.
+"""
+import numpy as np
+import xarray as xr
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+HAS_NUMEXPR = numexpr is not None
+
+# Dimiceli et al. (2013), in Horner form for t2mC (T) and rh in % (R)
+DIMICELI = ('-5.806 + T*(0.672 - 0.006*T)'
+            ' + R*(0.061 + T*(0.004 + 9.9e-5*T)'
+            ' + R*(-3.3e-5 - T*(5e-6 + 1e-7*T)))').replace('R','(rh*100.0)')
+
+# Gommers (2019), with Isw_in clipped at 0 W/m2 and ws2 at 0.1 m/s
+GOMMERS = ('where((A < 0) | (log(T) < 0.01), nan,'
+           ' -17.250591 + 0.4253438*sqrt(skt)*sqrt(A)'
+           ' + {I}*sqrt({I})*(7.09012e-05 - 4.750152e-06/{W})/{W}'
+           ' + log(T)*(0.04459706*sqrt({I}) - 7.534906e-04*{I}))').format(
+               I='where(Isw_in < 0, 0.0, Isw_in)',
+               W='where(ws2 < 0.1, 0.1, ws2)')
+
+# JAG/TI wind chill, with the wind at 1.5 m in km/h (W)
+JAGTI = ('13.12 + 0.6215*T + W*(0.3965*T - 11.37)').replace(
+    'W','(3.6*ws10)**0.16')
+
+def evaluate(expression,**arrays):
+    """Evaluates expression with numexpr, into an array of the dtype of the
+    arrays. numexpr calculates with float64 constants, the result is cast."""
+    dtype = np.result_type(*arrays.values())
+    out = np.empty(np.broadcast_shapes(*(np.shape(arr)
+                                         for arr in arrays.values())),
+                   dtype=dtype)
+    numexpr.evaluate(expression,local_dict=dict(arrays,nan=dtype.type(np.nan)),
+                     out=out,casting='unsafe')
+    return out
+
+def dimiceli(t2mC,rh):
+    """The WBGT of Dimiceli et al., from t2mC (deg C) and rh (fraction)"""
+    if HAS_NUMEXPR:
+        return evaluate(DIMICELI,T=t2mC,rh=rh)
+    R = np.multiply(rh,100)
+    # wbgt = a(T) + R*(b(T) + R*c(T))
+    wbgt = np.multiply(t2mC,-1e-7)
+    wbgt -= 5e-6
+    wbgt *= t2mC
+    wbgt -= 3.3e-5
+    wbgt *= R
+    tmp = np.multiply(t2mC,9.9e-5)
+    tmp += 0.004
+    tmp *= t2mC
+    tmp += 0.061
+    wbgt += tmp
+    wbgt *= R
+    np.multiply(t2mC,-0.006,out=tmp)
+    tmp += 0.672
+    tmp *= t2mC
+    tmp -= 5.806
+    wbgt += tmp
+    return wbgt
+
+def gommers(t2mC,skt,ACSM_wbgt,Isw_in,ws2):
+    """The WBGT of Gommers, from t2mC (deg C), skt (K), the ACSM WBGT
+    (deg C), Isw_in (W/m2) and ws2 (m/s). It is NaN where the ACSM WBGT is
+    negative or t2mC is below exp(0.01) deg C."""
+    if HAS_NUMEXPR:
+        return evaluate(GOMMERS,T=t2mC,skt=skt,A=ACSM_wbgt,
+                        Isw_in=Isw_in,ws2=ws2)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        Isw_in = np.clip(Isw_in,0,None)
+        sqrt_Isw = np.sqrt(Isw_in)
+        t2mClog = np.log(t2mC)
+        wbgt = np.sqrt(skt)
+        wbgt *= np.sqrt(ACSM_wbgt)
+        wbgt *= 0.4253438
+        wbgt -= 17.250591
+        # Isw_in**1.5 * (7.09012e-05 - 4.750152e-06/wind2m)/wind2m
+        wind2m_inv = np.clip(ws2,0.1,None)
+        np.reciprocal(wind2m_inv,out=wind2m_inv)
+        tmp = np.multiply(wind2m_inv,-4.750152e-06)
+        tmp += 7.09012e-05
+        tmp *= wind2m_inv
+        tmp *= Isw_in
+        tmp *= sqrt_Isw
+        wbgt += tmp
+        # t2mClog * (0.04459706*sqrt(Isw_in) - 7.534906e-04*Isw_in)
+        np.multiply(sqrt_Isw,0.04459706,out=tmp)
+        Isw_in *= 7.534906e-04
+        tmp -= Isw_in
+        tmp *= t2mClog
+        wbgt += tmp
+        invalid = np.less(ACSM_wbgt,0)
+        invalid |= t2mClog < 0.01
+    wbgt[invalid] = np.nan
+    return wbgt
+
+def jagti(t2mC,ws10):
+    """The JAG/TI wind chill, from t2mC (deg C) and ws10 (m/s)"""
+    if HAS_NUMEXPR:
+        return evaluate(JAGTI,T=t2mC,ws10=ws10)
+    wcet = np.multiply(ws10,3.6)
+    np.power(wcet,0.16,out=wcet)
+    tmp = np.multiply(t2mC,0.3965)
+    tmp -= 11.37
+    wcet *= tmp
+    np.multiply(t2mC,0.6215,out=tmp)
+    wcet += tmp
+    wcet += 13.12
+    return wcet
+
+def apply(kernel,*args):
+    """Runs kernel on the DataArrays in args, which are broadcast against
+    each other and cast to a common dtype first. Dask arrays are processed
+    chunk by chunk, in parallel.
+
+    Returns:
+        A DataArray without attributes
+    """
+    dtype = np.result_type(*(arg.dtype for arg in args))
+    args = [arg.astype(dtype,copy=False) for arg in xr.broadcast(*args)]
+    return xr.apply_ufunc(kernel,*args,dask='parallelized',
+                          output_dtypes=[dtype],keep_attrs=False)
@@ -0,0 +1,290 @@
+"""Fused residual and solver kernels of the Argonne model.
+
+These kernels are shared by tcitool.WBGT_ArgonneCalculator and the standalone
+argonne.py script. Every residual evaluates the reference temperature and the
+thermodynamic properties that depend on it (density, viscosity, conductivity,
+heat capacity, Prandtl and Schmidt numbers) only once.
+
+When numba is installed, the residuals are compiled to numpy ufuncs, and
+solve_tg/solve_tnw are compiled ufuncs running Brent's method for every
+element. Without numba, the same residuals are evaluated as numpy expressions,
+and solve_tg/solve_tnw fall back to tcitool.ArrayRootFinder.
+
+All kernels take the parameters in the order
+    t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal
+except the night kernels (Isw_in = 0), which only take the first six.
+"""
+import numpy as np
+
+import tcitool.func as tf
+from tcitool.calc.solver import ArrayRootFinder
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_NUMBA = numba is not None
+
+STEFANB = tf.m.STEFAN_BOLTZMANN
+Cp = 1003.5
+M_AIR = tf.td.MOLAR_MASS_AIR
+M_H2O = tf.td.MOLAR_MASS_H2O
+RATIO = Cp*M_AIR/M_H2O
+R_GAS = tf.td.GAS_CONSTANT
+R_AIR = R_GAS/M_AIR
+# define wick constants
+EMIS_WICK = 0.95
+ALB_WICK = 0.4
+D_WICK = 0.007
+L_WICK = 0.0254
+# define globe constants
+EMIS_GLOBE = 0.95
+ALB_GLOBE = 0.05
+D_GLOBE = 0.0508
+# define surface constants
+EMIS_SFC = 0.999
+
+def _tg_residual(Tg, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac,
+                 solcza, fal):
+    """Residual of the energy balance of the black globe [K^4]"""
+    tref = 0.5*(Tg + t2m)
+    esat = 0.611*np.exp(17.2694*(tref - 273.16)/(tref - 35.86))
+    emis = 0.575*(rh*esat)**0.143
+    dens = P_kPa*1e3/(R_AIR*tref)
+    visc = 1.458e-6*tref**1.5/(tref + 110.4)
+    cond = 0.02624*(tref/300)**0.8646
+    capp = 1002.5 + 275e-6*(tref - 200)**2
+    Re = ws*dens*D_GLOBE/visc
+    Nu = 2 + 0.6*np.sqrt(Re)*(capp*visc/cond)**0.3333
+    h = Nu*cond*D_GLOBE
+    return (0.5*emis*t2m**4
+            + 0.5*EMIS_SFC*skt**4
+            - h/(STEFANB*EMIS_GLOBE)*(Tg - t2m)
+            + Isw_in/(2.*STEFANB*EMIS_GLOBE)*(1. - ALB_GLOBE)
+                * (Isw_frac*(1./(2.*solcza) - 1.) + 1. + fal)
+            - Tg**4)
+
+def _tnw_residual(Tnw, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac,
+                  solcza, fal):
+    """Residual of the energy balance of the natural wet bulb [K]"""
+    tref = 0.5*(Tnw + t2m)
+    esat_tnw = 0.611*np.exp(17.2694*(Tnw - 273.16)/(Tnw - 35.86))
+    esat_t2m = 0.611*np.exp(17.2694*(t2m - 273.16)/(t2m - 35.86))
+    dens = P_kPa*1e3/(R_AIR*tref)
+    visc = 1.458e-6*tref**1.5/(tref + 110.4)
+    cond = 0.02624*(tref/300)**0.8646
+    capp = 1002.5 + 275e-6*(tref - 200)**2
+    evap = (313.15 - tref)/30*-71100 + 2.4073e6
+    Pr = capp*visc/cond
+    Sc = visc/(dens*(cond/(dens*capp)))
+    Re = ws*dens*D_WICK/visc
+    h = 0.281*Re**(1 - 0.4)*Pr**(1 - 0.56)*cond/D_WICK
+    wetfrac = (esat_tnw - rh*esat_t2m)/(P_kPa - esat_tnw)
+    Fatm = (STEFANB*EMIS_WICK*(
+                0.5*(0.575*(rh*esat_t2m)**0.143*t2m**4 + EMIS_SFC*skt**4)
+                - Tnw**4)
+            + (1. - ALB_WICK)*Isw_in*(
+                (1. - Isw_frac)*(1. + 0.25*D_WICK/L_WICK)
+                + Isw_frac*(np.tan(np.arccos(solcza))/np.pi
+                            + 0.25*D_WICK/L_WICK)
+                + fal))
+    return Tnw - (t2m - evap/RATIO*wetfrac*(Pr/Sc)**0.56 + Fatm/h)
+
+def _tg_residual_night(Tg, t2m, skt, rh, e_kPa, P_kPa, ws):
+    """Residual of the energy balance of the black globe [K^4], without
+    solar radiation"""
+    tref = 0.5*(Tg + t2m)
+    esat = 0.611*np.exp(17.2694*(tref - 273.16)/(tref - 35.86))
+    emis = 0.575*(rh*esat)**0.143
+    dens = P_kPa*1e3/(R_AIR*tref)
+    visc = 1.458e-6*tref**1.5/(tref + 110.4)
+    cond = 0.02624*(tref/300)**0.8646
+    capp = 1002.5 + 275e-6*(tref - 200)**2
+    Re = ws*dens*D_GLOBE/visc
+    Nu = 2 + 0.6*np.sqrt(Re)*(capp*visc/cond)**0.3333
+    h = Nu*cond*D_GLOBE
+    return (0.5*emis*t2m**4
+            + 0.5*EMIS_SFC*skt**4
+            - h/(STEFANB*EMIS_GLOBE)*(Tg - t2m)
+            - Tg**4)
+
+def _tnw_residual_night(Tnw, t2m, skt, rh, e_kPa, P_kPa, ws):
+    """Residual of the energy balance of the natural wet bulb [K], without
+    solar radiation"""
+    tref = 0.5*(Tnw + t2m)
+    esat_tnw = 0.611*np.exp(17.2694*(Tnw - 273.16)/(Tnw - 35.86))
+    esat_t2m = 0.611*np.exp(17.2694*(t2m - 273.16)/(t2m - 35.86))
+    dens = P_kPa*1e3/(R_AIR*tref)
+    visc = 1.458e-6*tref**1.5/(tref + 110.4)
+    cond = 0.02624*(tref/300)**0.8646
+    capp = 1002.5 + 275e-6*(tref - 200)**2
+    evap = (313.15 - tref)/30*-71100 + 2.4073e6
+    Pr = capp*visc/cond
+    Sc = visc/(dens*(cond/(dens*capp)))
+    Re = ws*dens*D_WICK/visc
+    h = 0.281*Re**(1 - 0.4)*Pr**(1 - 0.56)*cond/D_WICK
+    wetfrac = (esat_tnw - rh*esat_t2m)/(P_kPa - esat_tnw)
+    Fatm = STEFANB*EMIS_WICK*(
+        0.5*(0.575*(rh*esat_t2m)**0.143*t2m**4 + EMIS_SFC*skt**4) - Tnw**4)
+    return Tnw - (t2m - evap/RATIO*wetfrac*(Pr/Sc)**0.56 + Fatm/h)
+
+def _residual(which, x, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac,
+              solcza, fal):
+    """Selects the residual of Tg (which=0) or Tnw (which=1), or the residual
+    without solar radiation of Tg (which=2) or Tnw (which=3)"""
+    if which == 0:
+        return _tg_residual(x, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in,
+                            Isw_frac, solcza, fal)
+    if which == 1:
+        return _tnw_residual(x, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in,
+                             Isw_frac, solcza, fal)
+    if which == 2:
+        return _tg_residual_night(x, t2m, skt, rh, e_kPa, P_kPa, ws)
+    return _tnw_residual_night(x, t2m, skt, rh, e_kPa, P_kPa, ws)
+
+def _brentq(which, xa, xb, xtol, maxiter, t2m, skt, rh, e_kPa, P_kPa, ws,
+            Isw_in, Isw_frac, solcza, fal):
+    """Brent's method for a single element, following scipy.optimize.brentq.
+    Returns NaN when the root is not bracketed or did not converge."""
+    rtol = 4*2.220446049250313e-16
+    xpre, xcur = xa, xb
+    fpre = _residual(which, xpre, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in,
+                     Isw_frac, solcza, fal)
+    fcur = _residual(which, xcur, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in,
+                     Isw_frac, solcza, fal)
+    if not (np.isfinite(fpre) and np.isfinite(fcur)) or fpre*fcur > 0:
+        return np.nan
+    if fpre == 0:
+        return xpre
+    if fcur == 0:
+        return xcur
+    xblk = fblk = spre = scur = 0.
+    for _ in range(maxiter):
+        if fpre*fcur < 0:
+            xblk = xpre
+            fblk = fpre
+            spre = scur = xcur - xpre
+        if abs(fblk) < abs(fcur):
+            xpre = xcur
+            xcur = xblk
+            xblk = xpre
+            fpre = fcur
+            fcur = fblk
+            fblk = fpre
+        delta = (xtol + rtol*abs(xcur))/2
+        sbis = (xblk - xcur)/2
+        if fcur == 0 or abs(sbis) < delta:
+            return xcur
+        if abs(spre) > delta and abs(fcur) < abs(fpre):
+            if xpre == xblk:
+                stry = -fcur*(xcur - xpre)/(fcur - fpre)
+            else:
+                dpre = (fpre - fcur)/(xpre - xcur)
+                dblk = (fblk - fcur)/(xblk - xcur)
+                stry = -fcur*(fblk*dblk - fpre*dpre)/(dblk*dpre*(fblk - fpre))
+            if 2*abs(stry) < min(abs(spre), 3*abs(sbis) - delta):
+                spre = scur
+                scur = stry
+            else:
+                spre = sbis
+                scur = sbis
+        else:
+            spre = sbis
+            scur = sbis
+        xpre = xcur
+        fpre = fcur
+        if abs(scur) > delta:
+            xcur += scur
+        else:
+            xcur += (delta if sbis > 0 else -delta)
+        fcur = _residual(which, xcur, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in,
+                         Isw_frac, solcza, fal)
+    return np.nan
+
+if HAS_NUMBA:
+    _tg_residual = numba.njit(cache=True)(_tg_residual)
+    _tnw_residual = numba.njit(cache=True)(_tnw_residual)
+    _tg_residual_night = numba.njit(cache=True)(_tg_residual_night)
+    _tnw_residual_night = numba.njit(cache=True)(_tnw_residual_night)
+    _residual = numba.njit(cache=True)(_residual)
+    _brentq = numba.njit(cache=True)(_brentq)
+
+    tg_residual = numba.vectorize(cache=True)(_tg_residual.py_func)
+    tnw_residual = numba.vectorize(cache=True)(_tnw_residual.py_func)
+    tg_residual_night = numba.vectorize(cache=True)(
+        _tg_residual_night.py_func)
+    tnw_residual_night = numba.vectorize(cache=True)(
+        _tnw_residual_night.py_func)
+
+    @numba.vectorize(cache=True)
+    def _solve_tg(a, b, xtol, maxiter, t2m, skt, rh, e_kPa, P_kPa, ws,
+                  Isw_in, Isw_frac, solcza, fal):
+        return _brentq(0, a, b, xtol, maxiter, t2m, skt, rh,
+            e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal)
+
+    @numba.vectorize(cache=True)
+    def _solve_tnw(a, b, xtol, maxiter, t2m, skt, rh, e_kPa, P_kPa, ws,
+                   Isw_in, Isw_frac, solcza, fal):
+        return _brentq(1, a, b, xtol, maxiter, t2m, skt, rh,
+            e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal)
+
+    @numba.vectorize(cache=True)
+    def _solve_tg_night(a, b, xtol, maxiter, t2m, skt, rh, e_kPa, P_kPa, ws):
+        return _brentq(2, a, b, xtol, maxiter, t2m, skt, rh,
+            e_kPa, P_kPa, ws, 0., 0., 1., 0.)
+
+    @numba.vectorize(cache=True)
+    def _solve_tnw_night(a, b, xtol, maxiter, t2m, skt, rh, e_kPa, P_kPa, ws):
+        return _brentq(3, a, b, xtol, maxiter, t2m, skt, rh,
+            e_kPa, P_kPa, ws, 0., 0., 1., 0.)
+else:
+    tg_residual = _tg_residual
+    tnw_residual = _tnw_residual
+    tg_residual_night = _tg_residual_night
+    tnw_residual_night = _tnw_residual_night
+
+    def _solve_tg(a, b, xtol, maxiter, *params):
+        return ArrayRootFinder.solve(tg_residual, a, b, args=params,
+            xtol=xtol, maxiter=maxiter, method='brent')
+
+    def _solve_tnw(a, b, xtol, maxiter, *params):
+        return ArrayRootFinder.solve(tnw_residual, a, b, args=params,
+            xtol=xtol, maxiter=maxiter, method='brent')
+
+    def _solve_tg_night(a, b, xtol, maxiter, *params):
+        return ArrayRootFinder.solve(tg_residual_night, a, b, args=params,
+            xtol=xtol, maxiter=maxiter, method='brent')
+
+    def _solve_tnw_night(a, b, xtol, maxiter, *params):
+        return ArrayRootFinder.solve(tnw_residual_night, a, b, args=params,
+            xtol=xtol, maxiter=maxiter, method='brent')
+
+def solve_tg(a, b, xtol, maxiter, *params):
+    """Solves the globe temperature [K] for every element, between a and b [K].
+
+    Args:
+        a, b: (arrays of) the lower and upper limits of the bracket [K]
+        xtol: absolute tolerance of the root [K]
+        maxiter: maximum number of iterations
+        *params: the 10 input parameters (arrays)
+
+    Returns:
+        An array of globe temperatures, NaN where no root could be found
+    """
+    return _solve_tg(a, b, float(xtol), int(maxiter), *params)
+
+def solve_tnw(a, b, xtol, maxiter, *params):
+    """Solves the natural wet bulb temperature [K] for every element, between
+    a and b [K]. See solve_tg for the arguments."""
+    return _solve_tnw(a, b, float(xtol), int(maxiter), *params)
+
+def solve_tg_night(a, b, xtol, maxiter, *params):
+    """Solves the globe temperature [K] for elements without solar radiation
+    (Isw_in = 0), from the first six parameters. See solve_tg."""
+    return _solve_tg_night(a, b, float(xtol), int(maxiter), *params[:6])
+
+def solve_tnw_night(a, b, xtol, maxiter, *params):
+    """Solves the natural wet bulb temperature [K] for elements without solar
+    radiation (Isw_in = 0), from the first six parameters. See solve_tg."""
+    return _solve_tnw_night(a, b, float(xtol), int(maxiter), *params[:6])
@@ -25,11 +25,37 @@ class Calculator(object):
     def require_data(self,*args):
         self.tool.require_data(*args,operation_name=self.name)
 
+    def intermediate(self,key,func):
+        """Returns tool.data[key] if available, or else the result of func().
+
+        Within a fused Tool.calculate, the result is shared with the other
+        calculators of that pass, so e.g. t2mC is only calculated once."""
+        if key in self.tool.data:
+            return self.tool.data[key]
+        if self.tool.intermediates is None:
+            return func()
+        if key not in self.tool.intermediates:
+            self.tool.intermediates[key] = func()
+        return self.tool.intermediates[key]
+
     def export(self):
+        """Exports the export_params to tool.data. Within a fused
+        Tool.calculate, they are collected and exported at the end of the
+        pass instead.
+
+        As self.data is made by copy_empty, its coordinates are identical to
+        those of tool.data, and the variables are added without aligning
+        the datasets (see DataStore.assign_variables). When
+        tool.options['dtype'] is set, the results are cast to that dtype."""
         params = list(self.export_params.keys())
-        self.tool.data.merge(
-            self.data[params].rename_vars(**self.export_params)
-        )
+        export_ds = self.data[params].rename_vars(**self.export_params)
+        dtype = self.tool.compute_dtype()
+        if dtype is not None:
+            export_ds = export_ds.astype(dtype,keep_attrs=True)
+        if self.tool.pending_exports is not None:
+            self.tool.pending_exports.append(export_ds)
+        else:
+            self.tool.data.assign_variables(export_ds)
 
     def run(self):
         self.preface()
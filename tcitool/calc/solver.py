@@ -0,0 +1,261 @@
+import numpy as np
+
+class ArrayRootFinder(object):
+    """Bracketed root-finding on whole arrays at once.
+
+    All methods solve f(x, *args) = 0 for every element of the (broadcasted)
+    brackets [a, b] simultaneously. Each iteration is a single vectorized
+    evaluation of f on the elements that have not yet converged; converged
+    elements are masked out (and their arguments compressed away), while the
+    rest keep iterating.
+
+    The convergence criterion is the same as in scipy.optimize.brentq: the
+    returned root x satisfies |x - x0| <= xtol + rtol*|x0|, where x0 is the
+    exact root within the bracket. Elements where f(a) and f(b) do not have
+    different signs (or where f is not finite) return NaN.
+
+    Every method is implemented as three classmethods, operating on a dict of
+    arrays (the state) of the active elements:
+        _init_<method>(state): prepares the state from a, b, fa and fb
+        _propose_<method>(state,xtol,rtol): returns the mask of converged
+            elements, their root, and the next point to evaluate
+        _update_<method>(state,x,fx): processes the function value at x
+    """
+    METHODS = ('bisect','illinois','brent')
+    RTOL = 4*np.finfo(float).eps
+
+    @classmethod
+    def solve(cls,f,a,b,args=(),xtol=2e-12,rtol=None,maxiter=100,
+              method='brent',full_output=False):
+        """Finds the roots of f between a and b, for all elements at once.
+
+        Args:
+            f: callable f(x,*args), vectorized over numpy arrays
+            a, b: (arrays of) the lower and upper limits of the bracket
+            args: tuple of arrays, broadcastable to the shape of a and b
+            xtol, rtol: absolute and relative tolerance of the root
+            maxiter: maximum number of iterations
+            method: one of 'bisect', 'illinois' or 'brent'
+            full_output: if True, also return a dictionary with statistics
+
+        Returns:
+            An array of roots (NaN where no root could be bracketed), and if
+            full_output is set, a dict with the number of iterations per
+            element ('iterations'), the total number of function evaluations
+            ('function_calls'), and the boolean arrays 'converged' and
+            'bracketed'.
+        """
+        if method not in cls.METHODS:
+            raise ValueError("Unknown method '%s', use one of %s"%(
+                method,", ".join(cls.METHODS)))
+        init = getattr(cls,'_init_'+method)
+        propose = getattr(cls,'_propose_'+method)
+        update = getattr(cls,'_update_'+method)
+        rtol = cls.RTOL if rtol is None else rtol
+
+        arrays = np.broadcast_arrays(a,b,*args)
+        shape = arrays[0].shape
+        a, b = (np.array(arr,dtype=float).ravel() for arr in arrays[:2])
+        args = tuple(np.asarray(arr).ravel() for arr in arrays[2:])
+
+        root = np.full(a.shape,np.nan)
+        iterations = np.zeros(a.shape,dtype=int)
+        converged = np.zeros(a.shape,dtype=bool)
+        with np.errstate(all='ignore'):
+            fa = f(a,*args)
+            fb = f(b,*args)
+        ncalls = 2*a.size
+        bracketed = (np.isfinite(fa) & np.isfinite(fb) &
+                     (np.sign(fa)!=np.sign(fb)))
+
+        for x, fx in ((a,fa),(b,fb)):
+            exact = bracketed & ~converged & (fx==0)
+            root[exact] = x[exact]
+            converged |= exact
+        active = np.flatnonzero(bracketed & ~converged)
+        args = tuple(arg[active] for arg in args)
+        state = init({'a':a[active],'b':b[active],
+                      'fa':fa[active],'fb':fb[active]})
+
+        with np.errstate(all='ignore'):
+            for _ in range(maxiter):
+                if active.size==0:
+                    break
+                done, estimate, x = propose(state,xtol,rtol)
+                if done.any():
+                    root[active[done]] = estimate[done]
+                    converged[active[done]] = True
+                    keep = ~done
+                    active = active[keep]
+                    x = x[keep]
+                    state = {key: val[keep] for key, val in state.items()}
+                    args = tuple(arg[keep] for arg in args)
+                    if active.size==0:
+                        break
+                state = update(state,x,f(x,*args))
+                ncalls += active.size
+                iterations[active] += 1
+
+        root = root.reshape(shape)
+        if full_output:
+            return root, {
+                'iterations': iterations.reshape(shape),
+                'function_calls': ncalls,
+                'converged': converged.reshape(shape),
+                'bracketed': bracketed.reshape(shape),
+            }
+        return root
+
+    @classmethod
+    def secant(cls,f,x0,args=(),step=0.1,xtol=2e-12,maxiter=10,bounds=None):
+        """Finds the roots of f near an initial guess, for all elements at once.
+
+        The secant method converges fast when the initial guess is close to
+        the root, but it is not guaranteed to converge. Elements are
+        considered converged when the last step is smaller than xtol (as in
+        scipy.optimize.newton), and the root lies within the bounds.
+
+        Args:
+            f: callable f(x,*args), vectorized over numpy arrays
+            x0: array of initial guesses
+            args: tuple of arrays, broadcastable to the shape of x0
+            step: the second point is taken at x0 + step
+            xtol: absolute tolerance of the root
+            maxiter: maximum number of iterations
+            bounds: optional tuple (lower, upper); iterates outside these
+                bounds are considered diverged
+
+        Returns:
+            A tuple of np.arrays (roots, converged). Roots are NaN where the
+            method did not converge.
+        """
+        arrays = np.broadcast_arrays(x0,*args)
+        shape = arrays[0].shape
+        x0 = np.array(arrays[0],dtype=float).ravel()
+        args = tuple(np.asarray(arr).ravel() for arr in arrays[1:])
+        lower, upper = (-np.inf,np.inf) if bounds is None else bounds
+
+        root = np.full(x0.shape,np.nan)
+        active = np.flatnonzero(np.isfinite(x0))
+        args = tuple(arg[active] for arg in args)
+        xpre, xcur = x0[active], x0[active] + step
+        with np.errstate(all='ignore'):
+            fpre, fcur = f(xpre,*args), f(xcur,*args)
+            for _ in range(maxiter):
+                if active.size==0:
+                    break
+                dx = -fcur*(xcur - xpre)/(fcur - fpre)
+                xpre, fpre = xcur, fcur
+                xcur = xcur + dx
+                inside = (xcur>=lower) & (xcur<=upper)
+                done = (np.abs(dx)<xtol) & inside
+                root[active[done]] = xcur[done]
+                keep = ~done & inside & np.isfinite(xcur)
+                active = active[keep]
+                xpre, fpre, xcur = xpre[keep], fpre[keep], xcur[keep]
+                args = tuple(arg[keep] for arg in args)
+                if active.size==0:
+                    break
+                fcur = f(xcur,*args)
+        root = root.reshape(shape)
+        return root, np.isfinite(root)
+
+    @classmethod
+    def _init_bisect(cls,state):
+        return state
+    @classmethod
+    def _propose_bisect(cls,state,xtol,rtol):
+        a, b = state['a'], state['b']
+        mid = a + (b-a)/2
+        done = np.abs(b-a)/2 < (xtol + rtol*np.abs(mid))/2
+        return done, mid, mid
+    @classmethod
+    def _update_bisect(cls,state,x,fx):
+        lower = np.sign(fx)==np.sign(state['fa'])
+        exact = fx==0
+        state['a'] = np.where(lower|exact,x,state['a'])
+        state['fa'] = np.where(lower,fx,state['fa'])
+        state['b'] = np.where(lower&~exact,state['b'],x)
+        state['fb'] = np.where(lower,state['fb'],fx)
+        return state
+
+    @classmethod
+    def _init_illinois(cls,state):
+        return state
+    @classmethod
+    def _propose_illinois(cls,state,xtol,rtol):
+        """The bracket is kept as [a, b] (unordered), where b is the most recent
+        estimate. The regula falsi point is replaced by the midpoint when it
+        does not fall strictly within the bracket."""
+        a, b, fa, fb = state['a'], state['b'], state['fa'], state['fb']
+        done = (np.abs(b-a) < xtol + rtol*np.abs(b)) | (fb==0)
+        x = b - fb*(b-a)/(fb-fa)
+        inside = (x>np.minimum(a,b)) & (x<np.maximum(a,b))
+        x = np.where(inside,x,a + (b-a)/2)
+        return done, b, x
+    @classmethod
+    def _update_illinois(cls,state,x,fx):
+        """When the same end point is retained twice, its function value is
+        halved, to ensure superlinear convergence of the bracket width."""
+        retain = np.sign(fx)==np.sign(state['fb'])
+        state['fa'] = np.where(retain,state['fa']/2,state['fb'])
+        state['a'] = np.where(retain,state['a'],state['b'])
+        state['b'] = x
+        state['fb'] = fx
+        return state
+
+    @classmethod
+    def _init_brent(cls,state):
+        """Brent's method, following the implementation of
+        scipy.optimize.brentq, with each branch replaced by a masked array
+        operation."""
+        zeros = np.zeros_like(state['a'])
+        return {'xpre': state['a'], 'fpre': state['fa'],
+                'xcur': state['b'], 'fcur': state['fb'],
+                'xblk': zeros, 'fblk': zeros,
+                'spre': zeros, 'scur': zeros}
+    @classmethod
+    def _propose_brent(cls,state,xtol,rtol):
+        s = state
+        flip = (s['fpre']*s['fcur']) < 0
+        s['xblk'] = np.where(flip,s['xpre'],s['xblk'])
+        s['fblk'] = np.where(flip,s['fpre'],s['fblk'])
+        s['spre'] = np.where(flip,s['xcur']-s['xpre'],s['spre'])
+        s['scur'] = np.where(flip,s['xcur']-s['xpre'],s['scur'])
+
+        swap = np.abs(s['fblk']) < np.abs(s['fcur'])
+        xcur, fcur = s['xcur'], s['fcur']
+        s['xpre'] = np.where(swap,xcur,s['xpre'])
+        s['fpre'] = np.where(swap,fcur,s['fpre'])
+        s['xcur'] = np.where(swap,s['xblk'],xcur)
+        s['fcur'] = np.where(swap,s['fblk'],fcur)
+        s['xblk'] = np.where(swap,xcur,s['xblk'])
+        s['fblk'] = np.where(swap,fcur,s['fblk'])
+
+        delta = (xtol + rtol*np.abs(s['xcur']))/2
+        sbis = (s['xblk'] - s['xcur'])/2
+        done = (s['fcur']==0) | (np.abs(sbis)<delta)
+
+        interpolate = (np.abs(s['spre'])>delta) & (
+            np.abs(s['fcur'])<np.abs(s['fpre']))
+        stry_secant = -s['fcur']*(s['xcur']-s['xpre'])/(s['fcur']-s['fpre'])
+        dpre = (s['fpre']-s['fcur'])/(s['xpre']-s['xcur'])
+        dblk = (s['fblk']-s['fcur'])/(s['xblk']-s['xcur'])
+        stry_iqi = -s['fcur']*(s['fblk']*dblk - s['fpre']*dpre)/(
+            dblk*dpre*(s['fblk']-s['fpre']))
+        stry = np.where(s['xpre']==s['xblk'],stry_secant,stry_iqi)
+        accept = interpolate & (2*np.abs(stry) < np.minimum(
+            np.abs(s['spre']),3*np.abs(sbis)-delta))
+        s['spre'] = np.where(accept,s['scur'],sbis)
+        s['scur'] = np.where(accept,stry,sbis)
+
+        s['xpre'] = s['xcur']
+        s['fpre'] = s['fcur']
+        step = np.where(np.abs(s['scur'])>delta,s['scur'],
+                        np.where(sbis>0,delta,-delta))
+        return done, s['xcur'], s['xcur'] + step
+    @classmethod
+    def _update_brent(cls,state,x,fx):
+        state['xcur'] = x
+        state['fcur'] = fx
+        return state
@@ -1,6 +1,7 @@
 import numpy as np
 import xarray as xr
 import tcitool
+import tcitool.calc.approx_kernels as apk
 
 class WBGTapprox_ACSMCalculator(tcitool.Calculator):
     def __init__(self,tool):
@@ -9,12 +10,15 @@ class WBGTapprox_ACSMCalculator(tcitool.Calculator):
         self.require_data('t2m','d2m')
 
     def main(self):
-        t2mC = self.tool.data.get('t2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
-        d2mC = self.tool.data.get('d2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['d2m']))
-        vapor_pressure = 6.112 * np.exp((17.67*d2mC)/(d2mC+243.5))
-        wbgt = 0.567 * t2mC + 0.393 * vapor_pressure + 3.94
+        t2mC = self.intermediate('t2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
+        d2mC = self.intermediate('d2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['d2m']))
+        vapor_pressure = self.intermediate('ACSM_vapor_pressure',
+            lambda: 6.112 * np.exp((17.67*d2mC)/(d2mC+243.5)))
+        wbgt = self.intermediate('ACSM_wbgt',
+            lambda: 0.567 * t2mC + 0.393 * vapor_pressure + 3.94
+        ).copy(deep=False)
         wbgt.attrs = {
             'units': 'deg C',
             'long_name': 'Wet Bulb Globe Temperature (using ACSM '
@@ -32,8 +36,8 @@ class WBGTapprox_BernardCalculator(tcitool.Calculator):
         self.export_params = {'wbgt':'wbgt_bernard'}
         self.tool.require_data('t2m','e_kPa','solza')
     def main(self):
-        t2mC = self.tool.data.get('t2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
+        t2mC = self.intermediate('t2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
         direct_sun = xr.where(self.tool.data['solza']<1.57079615,1,0)
         direct_sun.attrs = {
             'units': 'bool',
@@ -60,19 +64,9 @@ class WBGTapprox_DimiceliCalculator(tcitool.Calculator):
         self.export_params = {'wbgt':'wbgt_dimiceli'}
         self.tool.require_data('t2m','rh')
     def main(self):
-        t2mC = self.tool.data.get('t2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
-        rh_procent = self.tool.data.get('rh_procent',
-            tcitool.UnitFuncs.rhfraction2procent(self.tool.data['rh']))
-        wbgt = (-5.806
-                + 0.672*t2mC
-                - 0.006*np.power(t2mC,2)
-                + 0.061*rh_procent
-                + 0.004*rh_procent*t2mC
-                + 9.9e-5*rh_procent*np.power(t2mC,2)
-                - 3.3e-5*np.power(rh_procent,2)
-                - 5e-6*np.power(rh_procent,2)*t2mC
-                - 1e-7*np.power(rh_procent,2)*np.power(t2mC,2))
+        t2mC = self.intermediate('t2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
+        wbgt = apk.apply(apk.dimiceli,t2mC,self.tool.data['rh'])
         wbgt.attrs = {
             'units': 'deg C',
             'long_name': 'Wet Bulb Globe Temperature (using Dimiceli et al. '
@@ -93,25 +87,17 @@ class WBGTapprox_GommersCalculator(tcitool.Calculator):
         self.export_params = {'wbgt':'wbgt_gommers'}
         self.tool.require_data('t2m','d2m','skt','ws2','Isw_in')
     def main(self):
-        t2mC = self.tool.data.get('t2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
-        d2mC = self.tool.data.get('d2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['d2m']))
-        Isw_in = np.clip(self.tool.data['Isw_in'],0,None)
-        ACSM_vapor_pressure = 6.112 * np.exp((17.67*d2mC)/(d2mC+243.5))
-        ACSM_wbgt = 0.567 * t2mC + 0.393 * ACSM_vapor_pressure + 3.94
-        wind2m = self.tool.data['ws2']
-        wind2m = np.clip(wind2m,0.1,None)
-        t2mClog = np.log(t2mC)
+        t2mC = self.intermediate('t2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
+        d2mC = self.intermediate('d2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['d2m']))
+        ACSM_vapor_pressure = self.intermediate('ACSM_vapor_pressure',
+            lambda: 6.112 * np.exp((17.67*d2mC)/(d2mC+243.5)))
+        ACSM_wbgt = self.intermediate('ACSM_wbgt',
+            lambda: 0.567 * t2mC + 0.393 * ACSM_vapor_pressure + 3.94)
 
-        wbgt = xr.where(ACSM_wbgt<0,np.nan,
-            xr.where(t2mClog<0.01,np.nan,
-            -17.250591
-            + 0.4253438 * np.sqrt(self.tool.data['skt']) * np.sqrt(ACSM_wbgt)
-            + 7.09012e-05 * np.power(Isw_in, 1.5) * np.reciprocal(wind2m)
-            - 4.750152e-06 * np.power(Isw_in, 1.5) * np.reciprocal(wind2m ** 2)
-            + 0.04459706 * t2mClog * np.sqrt(Isw_in)
-            - 7.534906e-04 * Isw_in * t2mClog))
+        wbgt = apk.apply(apk.gommers,t2mC,self.tool.data['skt'],ACSM_wbgt,
+            self.tool.data['Isw_in'],self.tool.data['ws2'])
         wbgt.attrs = {
             'units': 'deg C',
             'long_name': 'WBGT using the Gommers Stepwise Approximation '
@@ -2,18 +2,27 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import dask
-import dask.distributed as daskdist
 import dask.diagnostics as daskdiag
 import dask.array as da
 import scipy.optimize
 import concurrent.futures
+import itertools
+import json
+import os
 import tqdm
+import warnings
 from multiprocessing import cpu_count
+from multiprocessing import shared_memory
 
 import tcitool
 import tcitool.func as tf
+import tcitool.calc.argonne_kernels as ak
 
 class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
+    NIGHT = 0
+    LOW_SUN = 1
+    DAY = 2
+
     def __init__(self,tool,**kwargs):
         super().__init__(tool)
         self.export_params = {'wbgt':'wbgt_argonne',
@@ -24,9 +33,11 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
 
         self.hyperparams = kwargs
         self.fn = {}
+        self.solver_stats = {}
         self.const = {}
         self.daskarraydata = False
         self.daskarrayparams = False
+        self.dtype = tool.compute_dtype(np.float64)
 
     def preface(self):
         self.default_hyperparams()
@@ -41,6 +52,21 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
             self.hyperparams['Tnw_lim'] = (-60,90)
         if 'xtol' not in self.hyperparams:
             self.hyperparams['xtol'] = 0.01
+        if 'solver' not in self.hyperparams:
+            self.hyperparams['solver'] = ('compiled' if ak.HAS_NUMBA
+                                          else 'brent')
+        if 'maxiter' not in self.hyperparams:
+            self.hyperparams['maxiter'] = 100
+        if 'bracket' not in self.hyperparams:
+            self.hyperparams['bracket'] = 'physical'
+        if 'bracket_margin' not in self.hyperparams:
+            self.hyperparams['bracket_margin'] = 2
+        if 'bracket_width' not in self.hyperparams:
+            self.hyperparams['bracket_width'] = 5
+        if 'temporal' not in self.hyperparams:
+            self.hyperparams['temporal'] = False
+        if 'temporal_maxiter' not in self.hyperparams:
+            self.hyperparams['temporal_maxiter'] = 6
         if 'calcTpsy' not in self.hyperparams:
             self.hyperparams['calcTpsy'] = False
         if 'useTg150' not in self.hyperparams:
@@ -57,25 +83,25 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
 
     def constants(self):
         self.const['GRAVITY'] = tf.td.GRAVITATIONAL_AC
-        self.const['STEFANB'] = tf.m.STEFAN_BOLTZMANN
+        self.const['STEFANB'] = ak.STEFANB
         self.const['SOLAR_CONST'] = 1367.
-        self.const['Cp'] = 1003.5
-        self.const['M_AIR'] = tf.td.MOLAR_MASS_AIR
-        self.const['M_H2O'] = tf.td.MOLAR_MASS_H2O
-        self.const['RATIO'] = ( self.const['Cp']*self.const['M_AIR']/self.const['M_H2O'] )
-        self.const['R_GAS'] = tf.td.GAS_CONSTANT
-        self.const['R_AIR'] = ( self.const['R_GAS']/self.const['M_AIR'] )
+        self.const['Cp'] = ak.Cp
+        self.const['M_AIR'] = ak.M_AIR
+        self.const['M_H2O'] = ak.M_H2O
+        self.const['RATIO'] = ak.RATIO
+        self.const['R_GAS'] = ak.R_GAS
+        self.const['R_AIR'] = ak.R_AIR
         # define wick constants
-        self.const['EMIS_WICK'] = 0.95
-        self.const['ALB_WICK'] = 0.4
-        self.const['D_WICK'] = 0.007
-        self.const['L_WICK'] = 0.0254
+        self.const['EMIS_WICK'] = ak.EMIS_WICK
+        self.const['ALB_WICK'] = ak.ALB_WICK
+        self.const['D_WICK'] = ak.D_WICK
+        self.const['L_WICK'] = ak.L_WICK
         # define globe constants
-        self.const['EMIS_GLOBE'] = 0.95
-        self.const['ALB_GLOBE'] = 0.05
-        self.const['D_GLOBE'] = 0.0508
+        self.const['EMIS_GLOBE'] = ak.EMIS_GLOBE
+        self.const['ALB_GLOBE'] = ak.ALB_GLOBE
+        self.const['D_GLOBE'] = ak.D_GLOBE
         # define surface constants
-        self.const['EMIS_SFC'] = 0.999
+        self.const['EMIS_SFC'] = ak.EMIS_SFC
         # define computational and physical limits
         self.const['CZA_MIN'] = self.hyperparams['cza_min']
         self.const['MIN_SPEED'] = self.hyperparams['min_ws']
@@ -102,89 +128,28 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
                 self.tool.data['Ibeam']/self.data['Isw_in']),0,0.9)
         self.data['ws'] = np.clip(self.tool.data['ws2'],self.const['MIN_SPEED'],None)
         self.data['ws'].attrs = {
-            'units': self.tool.data['ws10'].attrs['units'],
+            'units': self.tool.data['ws2'].attrs['units'],
             'long_name': 'Estimated windspeed at 2m'}
 
         self.data = self.data[
                 ['t2m','skt','rh','e_kPa','msl_kPa','ws','Isw_in',
                 'Isw_frac','solcza','fal']
             ].rename_vars({'msl_kPa':'P_kPa'})
-        self.data = self.data.persist()
 
     def functions(self):
+        """The residuals of the energy balances of the globe and wet bulb,
+        see tcitool.calc.argonne_kernels"""
         self.fn = {
-            'tref': lambda temp1,temp2: 0.5*(temp1+temp2),
-            'esat': tf.m.saturated_vapor_pressure,
-            'evap': tf.td.heat_of_evaporation,
-            'emis': lambda temp_K, rh: tf.td.atmospheric_emissivity(
-                rh*tf.m.saturated_vapor_pressure(temp_K)),
-            'dens': tf.td.density,
-            'diff': tf.td.thermal_diffusivity,
-            'visc': tf.td.dynamic_viscosity,
-            'cond': tf.td.thermal_conductivity,
-            'Sc': tf.td.schmidt_number,
-            'Pr': tf.td.prandtl_number
+            'Tg': ak.tg_residual,
+            'Tnw': ak.tnw_residual,
+            'solve_Tg': ak.solve_tg,
+            'solve_Tnw': ak.solve_tnw,
+            'Tg_night': ak.tg_residual_night,
+            'Tnw_night': ak.tnw_residual_night,
+            'solve_Tg_night': ak.solve_tg_night,
+            'solve_Tnw_night': ak.solve_tnw_night,
         }
 
-        self.fn['BG_Re'] = lambda temp_K, P_kPa, ws: (
-            ws * self.fn['dens'](temp_K,P_kPa) * self.const['D_GLOBE'] /
-                self.fn['visc'](temp_K))
-        self.fn['BG_Nu'] = lambda temp_K, P_kPa, ws: (
-            2 + 0.6 * np.sqrt(self.fn['BG_Re'](temp_K, P_kPa, ws)) *
-                np.power(self.fn['Pr'](temp_K),0.3333))
-        self.fn['BG_h'] = lambda temp_K, P_kPa, ws: (
-            self.fn['BG_Nu'](temp_K, P_kPa, ws) * self.fn['cond'](temp_K) *
-                self.const['D_GLOBE'])
-        self.fn['h_sphere_in_air'] = lambda Tg, t2m, P_kPa, ws: (
-            self.fn['BG_h'](self.fn['tref'](Tg, t2m), P_kPa, ws))
-        self.fn['Tg'] = ( lambda Tg, t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in,
-            Isw_frac, solcza, fal:
-            0.5 * self.fn['emis'](self.fn['tref'](Tg, t2m),rh) * np.power(t2m,4.)
-            + 0.5 * self.const['EMIS_SFC'] * np.power(skt,4.)
-            - (self.fn['h_sphere_in_air'](Tg,t2m,P_kPa,ws) / (
-                self.const['STEFANB'] * self.const['EMIS_GLOBE']) * (Tg - t2m) )
-            + (Isw_in / (2. * self.const['STEFANB'] * self.const['EMIS_GLOBE']))
-                * (1. - self.const['ALB_GLOBE'])
-                * (Isw_frac*(1./(2.*solcza)-1.)+1.+fal) \
-            - np.power(Tg,4) )
-
-        self.fn['Fatm'] = ( lambda Tnw, t2m, skt, rh, Isw_in, Isw_frac, solcza,
-            fal:
-            self.const['STEFANB'] * self.const['EMIS_WICK'] * (
-                0.5*( self.fn['emis'](t2m,rh)*np.power(t2m,4.)
-                    + self.const['EMIS_SFC']*np.power(skt,4.))
-                - np.power(Tnw,4.))
-            + (1. - self.const['ALB_WICK']) * Isw_in * (
-                (1. - Isw_frac) * (
-                    1. + 0.25 * self.const['D_WICK'] / self.const['L_WICK'])
-                + Isw_frac * (
-                    (np.tan(np.arccos(solcza))/np.pi)
-                    + 0.25 * self.const['D_WICK'] / self.const['L_WICK'])
-                + fal) )
-        self.fn['NW_Re'] = lambda temp_K, P_kPa, ws: (
-            ws * self.fn['dens'](temp_K,P_kPa) * self.const['D_WICK'] /
-                self.fn['visc'](temp_K) )
-        self.fn['NW_Nu'] = lambda temp_K, P_kPa, ws: (
-            0.281 * np.power(self.fn['NW_Re'](temp_K, P_kPa, ws),1-0.4) *
-                np.power(self.fn['Pr'](temp_K),1-0.56) )
-        self.fn['NW_h'] = lambda temp_K, P_kPa, ws: (
-            self.fn['NW_Nu'](temp_K, P_kPa, ws) * self.fn['cond'](temp_K) /
-                self.const['D_WICK'] )
-        self.fn['h_cylinder_in_air'] = lambda Tnw, t2m, P_kPa, ws: (
-            self.fn['NW_h'](self.fn['tref'](Tnw, t2m), P_kPa, ws) )
-
-        self.fn['wetfrac'] = lambda Tnw, e_kPa, P_kPa: (
-            (self.fn['esat'](Tnw) - e_kPa)/(P_kPa - self.fn['esat'](Tnw)) )
-        self.fn['Tnw'] = ( lambda Tnw, t2m, skt, rh, e_kPa, P_kPa, ws,
-            Isw_in, Isw_frac, solcza, fal:
-            Tnw - (t2m - self.fn['evap'](self.fn['tref'](Tnw,t2m))
-                / self.const['RATIO']
-                * self.fn['wetfrac'](Tnw, rh*self.fn['esat'](t2m), P_kPa)
-                * np.power(self.fn['Pr'](self.fn['tref'](Tnw, t2m))
-                    / self.fn['Sc'](self.fn['tref'](Tnw, t2m),P_kPa),0.56)
-                + self.fn['Fatm'](Tnw,t2m,skt,rh,Isw_in,Isw_frac,solcza,fal)
-                    / self.fn['h_cylinder_in_air'](Tnw, t2m, P_kPa, ws)) )
-
     def optimize_params(self):
         return self.data[['t2m','skt','rh','e_kPa','P_kPa','ws','Isw_in',
             'Isw_frac','solcza','fal']]
@@ -195,9 +160,8 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
         params_tuple = tuple(params)[-len(param_list):]
 
         tg = np.nan
-        if self.hyperparams['daytime'] and (
-                params['solcza']<=self.const['CZA_MIN'] or
-                params['Isw_in']<=1 or params['Isw_frac']<=0.01):
+        if (self.hyperparams['daytime'] and
+                self.classify(np.asarray(params_tuple)) != self.DAY):
             return np.nan
         if len(params_tuple)<len(param_list):
             return np.nan
@@ -237,9 +201,8 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
         params_tuple = tuple(params)[-len(param_list):]
 
         tnw = np.nan
-        if self.hyperparams['daytime'] and (
-                params['solcza']<=self.const['CZA_MIN'] or
-                params['Isw_in']<=1 or params['Isw_frac']<=0.01):
+        if (self.hyperparams['daytime'] and
+                self.classify(np.asarray(params_tuple)) != self.DAY):
             return np.nan
         try:
             tnw = scipy.optimize.brentq(
@@ -272,63 +235,568 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
         return tnw
 
     def optimize_globe_temperature_aaa(self,data):
-        return np.apply_along_axis(
-            func1d=self.optimize_globe_temperature,
-            axis=0,
-            arr=data
-        )
+        return self.apply_along_axis(self.optimize_globe_temperature,data)
 
     def optimize_natural_wetbulb_temperature_aaa(self,data):
-        return np.apply_along_axis(
-            func1d=self.optimize_natural_wetbulb_temperature,
-            axis=0,
-            arr=data
-        )
+        return self.apply_along_axis(
+            self.optimize_natural_wetbulb_temperature,data)
+
+    def apply_along_axis(self,func1d,data):
+        """Applies func1d to every grid point of data, that is not skipped
+        (see daytime_mask). Skipped grid points are set to NaN."""
+        result = np.full(data.shape[1:],np.nan,dtype=data.dtype)
+        solve = ~self.daytime_mask(data)
+        if solve.any():
+            result[solve] = np.apply_along_axis(
+                func1d=func1d,
+                axis=0,
+                arr=data[:,solve])
+        return result
+
+    def classify(self,data):
+        """Classifies the grid points by the available solar radiation.
+
+            NIGHT: no solar radiation (the sun is below CZA_MIN, or Isw_in
+                is 0). The solar terms of the energy balances vanish, and
+                a residual without these terms is solved.
+            LOW_SUN: Isw_in of at most 1 W/m2, or a direct fraction of at most
+                0.01. These are solved as DAY, unless the 'daytime'
+                hyperparameter is set.
+            DAY: all other grid points.
+
+        Args:
+            data: an np.array with the 10 input parameters along axis 0
+
+        Returns:
+            An np.array of data.shape[1:] with the class of every grid point
+        """
+        param_list = ['t2m','skt','rh','e_kPa','P_kPa','ws','Isw_in',
+            'Isw_frac','solcza','fal']
+        solcza = data[param_list.index('solcza')]
+        Isw_in = data[param_list.index('Isw_in')]
+        Isw_frac = data[param_list.index('Isw_frac')]
+        classes = np.full(np.shape(solcza),self.DAY,dtype=np.int8)
+        classes[(Isw_in<=1) | (Isw_frac<=0.01)] = self.LOW_SUN
+        classes[(solcza<=self.const['CZA_MIN']) | (Isw_in<=0)] = self.NIGHT
+        return classes
+
+    def daytime_mask(self,data):
+        """Returns a boolean array, that is True for grid points that should
+        not be solved (NIGHT and LOW_SUN, see classify), when the 'daytime'
+        hyperparameter is set."""
+        if not self.hyperparams['daytime']:
+            return np.zeros(data.shape[1:],dtype=bool)
+        return self.classify(data) != self.DAY
+
+    def optimize_vectorized(self,tg_or_tnw,data):
+        """Solves Tg or Tnw for all grid points in data at once.
+
+        The bracket of every grid point is chosen by the 'bracket'
+        hyperparameter:
+            'wide': the full Tg_lim or Tnw_lim range
+            'physical': a narrow bracket derived from the energy balance at
+                the air temperature (see physical_bracket)
+            'previous': the solution of the previous time step (axis 1 of
+                data) +/- 'bracket_width' K. The first time step, and grid
+                points without a previous solution use 'physical'.
+        Grid points where the narrow bracket does not contain a sign change
+        are solved again using the wide bracket.
+
+        If the 'temporal' hyperparameter is set, the time steps are solved one
+        after the other, see optimize_temporal.
+
+        Args:
+            tg_or_tnw: 'Tg' or 'Tnw'
+            data: an np.array with the 10 input parameters along axis 0
+
+        Returns:
+            An np.array of data.shape[1:], NaN where no solution was found
+        """
+        skip = self.daytime_mask(data)
+        if self.hyperparams['temporal'] and data.ndim > 2:
+            return self.optimize_temporal(tg_or_tnw,data,skip)
+        if self.hyperparams['bracket'] == 'previous' and data.ndim > 2:
+            result = np.full(data.shape[1:],np.nan,dtype=data.dtype)
+            previous = None
+            for t in range(data.shape[1]):
+                result[t] = self.optimize_points(
+                    tg_or_tnw,data[:,t],skip[t],previous)
+                previous = result[t]
+            return result
+        return self.optimize_points(tg_or_tnw,data,skip)
+
+    def optimize_temporal(self,tg_or_tnw,data,skip):
+        """Solves Tg or Tnw time step by time step (axis 1 of data), reusing
+        the solution of the previous time step.
+
+        The solution at t-1 is used as the initial guess of a few secant
+        iterations at t (at most 'temporal_maxiter'). Grid points that do not
+        converge within the Tg_lim or Tnw_lim range, and the first time step,
+        are solved using the bracketed solver (see optimize_points). The
+        number of grid points that took the fast path is counted in
+        self.solver_stats[tg_or_tnw]['temporal'].
+
+        Returns:
+            An np.array of data.shape[1:], NaN where no solution was found
+        """
+        lim = tf.u.tempC2K(np.array(self.hyperparams[tg_or_tnw+'_lim'],
+                                    dtype=data.dtype))
+        stats = self.solver_stats.setdefault(tg_or_tnw,
+            {'points': 0, 'fallback': 0, 'unsolved': 0})
+        stats.setdefault('temporal',0)
+        result = np.full(data.shape[1:],np.nan,dtype=data.dtype)
+        for t in range(data.shape[1]):
+            solve = ~skip[t]
+            if t == 0 or not solve.any():
+                result[t] = self.optimize_points(tg_or_tnw,data[:,t],skip[t])
+                continue
+            params = data[:,t][:,solve]
+            roots, fast = tcitool.ArrayRootFinder.secant(
+                self.fn[tg_or_tnw],
+                result[t-1][solve],
+                args=tuple(params),
+                xtol=self.hyperparams['xtol'],
+                maxiter=self.hyperparams['temporal_maxiter'],
+                bounds=tuple(lim))
+            if not fast.all():
+                roots[~fast] = self.optimize_points(tg_or_tnw,
+                    params[:,~fast],np.zeros(np.count_nonzero(~fast),dtype=bool))
+            result[t][solve] = roots
+            stats['points'] += int(np.count_nonzero(fast))
+            stats['night'] = (stats.get('night',0) +
+                              int(np.count_nonzero(params[6][fast]<=0)))
+            stats['temporal'] += int(np.count_nonzero(fast))
+        return result
+
+    def optimize_points(self,tg_or_tnw,data,skip,previous=None):
+        """Solves Tg or Tnw for all grid points in data that are not skipped,
+        see optimize_vectorized.
+
+        Args:
+            tg_or_tnw: 'Tg' or 'Tnw'
+            data: an np.array with the 10 input parameters along axis 0
+            skip: a boolean np.array of data.shape[1:], True for grid points
+                that are set to NaN without solving
+            previous: optional np.array of data.shape[1:], containing the
+                solution of the previous time step
+
+        Returns:
+            An np.array of data.shape[1:], NaN where no solution was found
+        """
+        lim = tf.u.tempC2K(np.array(self.hyperparams[tg_or_tnw+'_lim'],
+                                    dtype=data.dtype))
+        result = np.full(data.shape[1:],np.nan,dtype=data.dtype)
+        solve = ~skip
+        if not solve.any():
+            return result
+        params = tuple(data[:,solve])
+        if self.hyperparams['bracket'] == 'wide':
+            a, b = lim
+        else:
+            a, b = self.physical_bracket(tg_or_tnw,params)
+            if previous is not None:
+                width = self.hyperparams['bracket_width']
+                seeded = np.isfinite(previous[solve])
+                a = np.where(seeded,previous[solve]-width,a)
+                b = np.where(seeded,previous[solve]+width,b)
+            a, b = np.clip(a,*lim), np.clip(b,*lim)
+        roots = self.solve_bracket(tg_or_tnw,a,b,params)
+
+        unsolved = np.isnan(roots) & np.all(np.isfinite(params),axis=0)
+        retry = (unsolved if self.hyperparams['bracket'] != 'wide'
+                 else np.zeros_like(unsolved))
+        if retry.any():
+            roots[retry] = self.solve_bracket(tg_or_tnw,lim[0],lim[1],
+                tuple(param[retry] for param in params))
+            unsolved = np.isnan(roots) & np.all(np.isfinite(params),axis=0)
+        result[solve] = roots
+
+        stats = self.solver_stats.setdefault(tg_or_tnw,
+            {'points': 0, 'fallback': 0, 'unsolved': 0})
+        stats['points'] += roots.size
+        stats['night'] = (stats.get('night',0) +
+                          int(np.count_nonzero(params[6]<=0)))
+        stats['fallback'] += int(np.count_nonzero(retry))
+        stats['unsolved'] += int(np.count_nonzero(unsolved))
+        if unsolved.any():
+            warnings.warn(('No %s could be found for %d grid points '
+                'between %+06.1f °C and %+06.1f °C. These are set to NaN.')%(
+                tg_or_tnw,np.count_nonzero(unsolved),
+                *self.hyperparams[tg_or_tnw+'_lim']),tcitool.SolverWarning)
+        return result
+
+    def physical_bracket(self,tg_or_tnw,params):
+        """Estimates a narrow bracket of Tg or Tnw, from the energy balance.
+
+        The residual r is evaluated once at the air temperature, where the
+        convective term vanishes. For Tg, (r + t2m^4)^(1/4) is the radiative
+        equilibrium temperature of the globe; convection moves the solution
+        from there towards t2m. For Tnw, the slope of the residual is at least
+        1, so the solution lies between t2m and t2m - r. Both brackets are
+        widened by 'bracket_margin' K plus a quarter of their width, to
+        account for the approximations (e.g. the emissivity of the air is
+        evaluated at t2m).
+
+        Returns:
+            A tuple of np.arrays (lower, upper) [K]
+        """
+        t2m = params[0]
+        with np.errstate(all='ignore'):
+            residual = self.fn[tg_or_tnw](t2m,*params)
+            if tg_or_tnw == 'Tg':
+                estimate = np.power(residual + np.power(t2m,4),0.25)
+            else:
+                estimate = t2m - residual
+        margin = (self.hyperparams['bracket_margin'] +
+                  0.25*np.abs(estimate - t2m))
+        return (np.fmin(t2m,estimate) - margin,
+                np.fmax(t2m,estimate) + margin)
+
+    def solve_bracket(self,tg_or_tnw,a,b,params):
+        """Solves Tg or Tnw between a and b [K]. Grid points without solar
+        radiation (Isw_in = 0) are solved using the cheaper residual without
+        solar terms, see solve_residual."""
+        night = params[6]<=0
+        if not night.any():
+            return self.solve_residual(tg_or_tnw,a,b,params)
+        a, b = np.broadcast_arrays(a,b,night)[:2]
+        day = ~night
+        roots = np.empty(night.shape,dtype=params[0].dtype)
+        roots[night] = self.solve_residual(tg_or_tnw+'_night',
+            a[night],b[night],tuple(param[night] for param in params[:6]))
+        if day.any():
+            roots[day] = self.solve_residual(tg_or_tnw,
+                a[day],b[day],tuple(param[day] for param in params))
+        return roots
+
+    def solve_residual(self,residual,a,b,params):
+        """Solves the residual self.fn[residual] between a and b [K], using
+        the solver selected by the 'solver' hyperparameter: 'compiled'
+        (Brent's method compiled per grid point, requires numba) or one of
+        the vectorized methods of tcitool.ArrayRootFinder."""
+        if self.hyperparams['solver'] == 'compiled':
+            return self.fn['solve_'+residual](
+                a,b,
+                self.hyperparams['xtol'],
+                self.hyperparams['maxiter'],
+                *params)
+        return tcitool.ArrayRootFinder.solve(
+            self.fn[residual],
+            a,b,
+            args=params,
+            xtol=self.hyperparams['xtol'],
+            maxiter=self.hyperparams['maxiter'],
+            method=self.hyperparams['solver'])
+
+    def optimize_globe_temperature_vec(self,data):
+        return self.optimize_vectorized('Tg',data)
+
+    def optimize_natural_wetbulb_temperature_vec(self,data):
+        return self.optimize_vectorized('Tnw',data)
+
+    def optimize_block(self,data):
+        """Solves Tg and Tnw for a block of data, in the same pass.
+
+        Args:
+            data: an np.array with the 10 input parameters along axis 0
 
-    def optimize(self,rechunk=None):
-        if self.tool.data.shape != self.tool.data.chunks:
-            if self.tool.dask_client is None:
-                self.tool.dask_client = daskdist.Client()
-            client = self.tool.dask_client
-            daskds = self.optimize_params()
-            daskds_params = [daskds[key].data for key in daskds.keys()]
-            daskarray = da.stack(daskds_params, axis=0)
-            dataarray = daskarray.compute()
+        Returns:
+            A tuple of np.arrays (tg, tnw) of shape data.shape[1:]
+        """
+        if (self.hyperparams['solver'] == 'compiled' or
+                self.hyperparams['solver'] in tcitool.ArrayRootFinder.METHODS):
+            return (self.optimize_globe_temperature_vec(data),
+                    self.optimize_natural_wetbulb_temperature_vec(data))
+        elif self.hyperparams['solver'] == 'brentq':
+            return (self.optimize_globe_temperature_aaa(data),
+                    self.optimize_natural_wetbulb_temperature_aaa(data))
+        raise ValueError("Unknown solver '%s'"%self.hyperparams['solver'])
+
+    def tiles(self,shape,workers):
+        """Splits the (time, longitude, latitude) cube in blocks.
+
+        The block size is taken from tool.options['argonne_tile_size'] (a
+        dict of dimension names to sizes, missing dimensions are not split).
+        When this option is not set, the cube is split along the first
+        dimensions until there are about 4 tiles per worker.
+
+        Returns:
+            A list of tuples of slices, one for every tile
+        """
+        dims = self.data['t2m'].dims
+        tile_size = self.tool.options.get('argonne_tile_size')
+        if tile_size is None:
+            tile_size = {}
+            ntiles = 1
+            for dim, size in zip(dims,shape):
+                if ntiles >= 4*workers:
+                    break
+                splits = min(size,-(-4*workers//ntiles))
+                tile_size[dim] = -(-size//splits)
+                ntiles *= -(-size//tile_size[dim])
+        steps = [tile_size.get(dim,size) for dim, size in zip(dims,shape)]
+        return [tuple(slice(start,start+step) for start, step in zip(starts,steps))
+                for starts in itertools.product(*(
+                    range(0,size,step) for size, step in zip(shape,steps)))]
+
+    def optimize_stack(self,out=None,isel=None):
+        """Stacks the input parameters into one np.array (parameters along
+        axis 0), without keeping an extra copy of each parameter.
+
+        Args:
+            out: optional np.array to store the stack in
+            isel: optional dict of dimension names to indexers, to stack only
+                a part of the data
+
+        Returns:
+            The stacked np.array
+        """
+        xds = self.optimize_params()
+        if isel is not None:
+            xds = xds.isel(isel)
+        keys = list(xds.keys())
+        if out is None:
+            out = np.empty((len(keys),)+xds[keys[0]].shape,dtype=self.dtype)
+        for i, key in enumerate(keys):
+            if isinstance(xds[key].data,da.Array):
+                da.store(xds[key].data,out[i])
+            else:
+                out[i] = xds[key].values
+        return out
+
+    def optimize(self):
+        """Solves Tg and Tnw for the whole dataset.
+
+        The cube is split in tiles (see tiles), which are solved in parallel
+        by a pool of tool.options['argonne_workers'] processes (default: the
+        number of CPUs). The input and output arrays are placed in shared
+        memory, so the workers only receive the location of their tile, and
+        write their results directly into the output array.
+
+        When the data is chunked, the solve is added lazily to the dask graph
+        instead (see optimize_dask). When tool.options['argonne_shard_dir'] is
+        set, the data is solved in resumable shards (see optimize_shards).
+        """
+        workers = self.tool.options.get('argonne_workers',cpu_count())
+        if self.tool.options.get('argonne_shard_dir') is not None:
+            tg_arr, tnw_arr = self.optimize_shards(
+                self.tool.options['argonne_shard_dir'],workers,
+                self.tool.options.get('argonne_shard_size',1))
+        elif self.is_lazy():
+            tg, tnw = self.optimize_dask()
+            self.data['tg_5cm'] = tg
+            self.data['tnw'] = tnw
+            return
+        elif workers <= 1:
+            tg_arr, tnw_arr = self.optimize_block(self.optimize_stack())
+        else:
+            tg_arr, tnw_arr = self.optimize_parallel(workers)
+        dims = self.data['t2m'].dims
+        self.data['tg_5cm'] = dims, tg_arr
+        self.data['tnw'] = dims, tnw_arr
+
+    def is_lazy(self):
+        """True if (some of) the input parameters are dask arrays"""
+        xds = self.optimize_params()
+        return any(isinstance(xds[key].data,da.Array) for key in xds.keys())
+
+    def optimize_dask(self):
+        """Adds the solve of Tg and Tnw to the dask graph, block by block.
+
+        Every block of the existing chunks is solved independently (using
+        optimize_block), so the full stack of input parameters is never
+        materialised. The computation is run by the active dask scheduler
+        (e.g. tool.dask_client), when the results are computed or persisted.
+
+        Returns:
+            A tuple of lazy xarray.DataArrays (tg_5cm, tnw)
+        """
+        xds = self.optimize_params()
+        return xr.apply_ufunc(
+            _solve_block,
+            *(xds[key] for key in xds.keys()),
+            kwargs={'calc': self},
+            output_core_dims=[[],[]],
+            dask='parallelized',
+            output_dtypes=[self.dtype,self.dtype])
+
+    def optimize_parallel(self,workers):
+        nparams = len(self.optimize_params().keys())
+        shape = self.data['t2m'].shape
+        itemsize = self.dtype.itemsize
+        shm_inp = shared_memory.SharedMemory(
+            create=True,size=nparams*int(np.prod(shape))*itemsize)
+        shm_out = shared_memory.SharedMemory(
+            create=True,size=2*int(np.prod(shape))*itemsize)
+        try:
+            inp = np.ndarray((nparams,)+shape,dtype=self.dtype,
+                             buffer=shm_inp.buf)
+            out = np.ndarray((2,)+shape,dtype=self.dtype,buffer=shm_out.buf)
+            self.optimize_stack(out=inp)
+            out[...] = np.nan
+
+            tiles = self.tiles(shape,workers)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_tile_worker,
+                    initargs=(self,
+                        (shm_inp.name,inp.shape,inp.dtype),
+                        (shm_out.name,out.shape,out.dtype))) as executor:
+                futures = [executor.submit(_solve_tile,tile) for tile in tiles]
+                with tqdm.tqdm(total=len(tiles)) as progress:
+                    for future in concurrent.futures.as_completed(futures):
+                        self.merge_solver_stats(future.result())
+                        progress.update()
+            tg_arr, tnw_arr = out[0].copy(), out[1].copy()
+            del inp, out
+        finally:
+            for shm in (shm_inp, shm_out):
+                shm.close()
+                shm.unlink()
+        return tg_arr, tnw_arr
+
+    def optimize_shards(self,folder,workers,shard_size=1):
+        """Solves Tg and Tnw in shards of shard_size time steps, which can be
+        resumed after an interruption.
+
+        The results are written to the memory-mapped array output.npy (Tg and
+        Tnw along axis 0) in folder. Every finished shard is recorded in
+        manifest.json. When the folder already contains a manifest of the
+        same data, the finished shards are skipped (unless output.npy is
+        missing, then all shards are solved again). The input of every shard
+        is stacked only when it is send to one of the workers (at most two
+        shards per worker are in flight), so no copy of the full input is
+        made.
+
+        Args:
+            folder: the directory of the output and manifest
+            workers: number of worker processes, the shards are solved in
+                this process when workers <= 1
+            shard_size: number of time steps per shard
+
+        Returns:
+            A tuple of (memory-mapped) np.arrays (tg, tnw)
+        """
+        folder = os.path.abspath(folder)
+        os.makedirs(folder,exist_ok=True)
+        manifest = self.shard_manifest(folder,shard_size)
+        output_file = os.path.join(folder,'output.npy')
+        shape = (2,)+tuple(manifest['shape'])
+        if os.path.isfile(output_file):
+            out = np.load(output_file,mmap_mode='r+')
+            if out.shape != shape or out.dtype != self.dtype:
+                raise ValueError(('The output in %s does not belong to this '
+                    'data (shape %s and dtype %s instead of %s and %s). '
+                    'Remove it, or use an other folder.')%(
+                    folder,out.shape,out.dtype,shape,self.dtype))
         else:
-            xds = self.optimize_params()
-            dataarray = np.stack([xds[key].values for key in xds.keys()],axis=0)
-        np.save('tmp.npy',dataarray)
-        shape = dataarray.shape
-        tg_arr = np.full(shape[1:],np.nan)
-        tnw_arr = np.full(shape[1:],np.nan)
-
-        with concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-            with tqdm.tqdm(total=shape[1]*shape[2]) as progress:
-                future_to_id = {}
-                for i in range(shape[1]*shape[2]):
-                    x, y = i//shape[2], i%shape[2]
-                    future = executor.submit(
-                        self.optimize_globe_temperature_aaa,
-                        dataarray[:,x,y,:])
-                    future.add_done_callback(lambda p: progress.update())
-                    future_to_id[future] = i
-                for future in concurrent.futures.as_completed(future_to_id):
-                    i = future_to_id[future]
-                    tg_arr[i//s[2],i%s[2],:] = future.result()
-        with concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-            with tqdm.tqdm(total=shape[1]*shape[2]) as progress:
-                future_to_id = {}
-                for i in range(shape[1]*shape[2]):
-                    future = executor.submit(
-                        self.optimize_natural_wetbulb_temperature_aaa,
-                        dataarray[:,x,y,:])
-                    future.add_done_callback(lambda p: progress.update())
-                    future_to_id[future] = i
-                for future in concurrent.futures.as_completed(future_to_id):
-                    i = future_to_id[future]
-                    tnw_arr[i//s[2],i%s[2],:] = future.result()
-        self.data['tg_5cm'] = ['time','latitude','longitude'], tg_arr
-        self.data['tnw'] = ['time','latitude','longitude'], tnw_arr
+            # the results of shards completed before are lost with the output
+            manifest['completed'] = []
+            self.write_shard_manifest(folder,manifest)
+            out = np.lib.format.open_memmap(output_file,mode='w+',
+                dtype=self.dtype,shape=shape)
+            out[...] = np.nan
+            out.flush()
+        time_dim = manifest['dims'][0]
+        pending = [i for i in range(len(manifest['shards']))
+                   if i not in manifest['completed']]
+
+        progress = tqdm.tqdm(total=len(manifest['shards']),
+                             initial=len(manifest['completed']))
+        def complete(index,stats):
+            self.merge_solver_stats(stats)
+            manifest['completed'].append(index)
+            self.write_shard_manifest(folder,manifest)
+            progress.update()
+
+        if workers <= 1:
+            for i in pending:
+                start, stop = manifest['shards'][i]
+                out[:,start:stop] = self.optimize_block(self.optimize_stack(
+                    isel={time_dim: slice(start,stop)}))
+                out.flush()
+                complete(i,{})
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_shard_worker,
+                    initargs=(self,output_file)) as executor:
+                running = set()
+                for i in pending:
+                    if len(running) >= 2*workers:
+                        done, running = concurrent.futures.wait(running,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            complete(*future.result())
+                    start, stop = manifest['shards'][i]
+                    running.add(executor.submit(_solve_shard,i,start,stop,
+                        self.optimize_stack(
+                            isel={time_dim: slice(start,stop)})))
+                for future in concurrent.futures.as_completed(running):
+                    complete(*future.result())
+        progress.close()
+        return out[0], out[1]
+
+    def shard_manifest(self,folder,shard_size):
+        """Reads the manifest of optimize_shards from folder, or creates a new
+        one. Raises a ValueError if the manifest in folder belongs to other
+        data."""
+        t2m = self.data['t2m']
+        time_dim = t2m.dims[0]
+        ntime = t2m.shape[0]
+        manifest = {
+            'shape': list(t2m.shape),
+            'dims': list(t2m.dims),
+            'time': [str(t2m[time_dim].values[0]),
+                     str(t2m[time_dim].values[-1])],
+            'shards': [[start,min(start+shard_size,ntime)]
+                       for start in range(0,ntime,shard_size)],
+            'completed': [],
+        }
+        manifest_file = os.path.join(folder,'manifest.json')
+        if not os.path.isfile(manifest_file):
+            self.write_shard_manifest(folder,manifest)
+            return manifest
+        with open(manifest_file) as fh:
+            existing = json.load(fh)
+        for key in ('shape','dims','time','shards'):
+            if existing.get(key) != manifest[key]:
+                raise ValueError(('The manifest in %s does not belong to this '
+                    'data (different %s). Remove it, or use an other '
+                    'folder.')%(folder,key))
+        return existing
+
+    def write_shard_manifest(self,folder,manifest):
+        """Writes the manifest of optimize_shards, replacing the previous one
+        only when it has been written completely."""
+        manifest_file = os.path.join(folder,'manifest.json')
+        with open(manifest_file+'.tmp','w') as fh:
+            json.dump(manifest,fh)
+        os.replace(manifest_file+'.tmp',manifest_file)
+
+    def merge_solver_stats(self,stats):
+        """Adds the solver statistics of (e.g.) an other process to
+        self.solver_stats"""
+        for tg_or_tnw, counts in stats.items():
+            own = self.solver_stats.setdefault(tg_or_tnw,{})
+            for key, count in counts.items():
+                own[key] = own.get(key,0) + count
+
+    def __getstate__(self):
+        """Only the hyperparameters and constants are pickled, when this
+        calculator is send to an other process. The functions are rebuilt
+        there, while the tool and data are not available."""
+        return {'name': self.name,
+                'hyperparams': self.hyperparams,
+                'const': self.const,
+                'dtype': self.dtype,
+                'solver_stats': {}}
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.tool = None
+        self.data = None
+        self.functions()
 
     def postface(self):
         self.closing_calculations()
@@ -378,3 +846,47 @@ class WBGT_ArgonneCalculator(tcitool.OptimizationCalculator):
                 'Occupational and Environmental Hygiene, 5 (10), 645–655, '
                 'doi: 10.1080/15459620802310770'
         }
+
+def _solve_block(*params,calc):
+    """Solves a single block of the dask graph, see
+    WBGT_ArgonneCalculator.optimize_dask"""
+    return calc.optimize_block(np.stack(params,axis=0))
+
+_tile_worker = {}
+def _init_tile_worker(calc,inp_spec,out_spec):
+    """Initializer of the worker processes of
+    WBGT_ArgonneCalculator.optimize_parallel. Attaches to the shared memory
+    of the input and output arrays."""
+    _tile_worker['calc'] = calc
+    for key, (name, shape, dtype) in (('inp',inp_spec),('out',out_spec)):
+        shm = shared_memory.SharedMemory(name=name)
+        _tile_worker[key+'_shm'] = shm
+        _tile_worker[key] = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+
+def _solve_tile(tile):
+    """Solves a single tile (a tuple of slices) in a worker process, and
+    returns the solver statistics of this tile."""
+    calc = _tile_worker['calc']
+    calc.solver_stats = {}
+    tg, tnw = calc.optimize_block(_tile_worker['inp'][(slice(None),)+tile])
+    _tile_worker['out'][(0,)+tile] = tg
+    _tile_worker['out'][(1,)+tile] = tnw
+    return calc.solver_stats
+
+_shard_worker = {}
+def _init_shard_worker(calc,output_file):
+    """Initializer of the worker processes of
+    WBGT_ArgonneCalculator.optimize_shards. Opens the output array."""
+    _shard_worker['calc'] = calc
+    _shard_worker['out'] = np.load(output_file,mmap_mode='r+')
+
+def _solve_shard(index,start,stop,data):
+    """Solves a single shard (time steps start to stop) in a worker process,
+    writes it to the output array, and returns the index and the solver
+    statistics of this shard."""
+    calc = _shard_worker['calc']
+    calc.solver_stats = {}
+    out = _shard_worker['out']
+    out[:,start:stop] = calc.optimize_block(data)
+    out.flush()
+    return index, calc.solver_stats
@@ -0,0 +1,355 @@
+import itertools
+import os
+
+import numpy as np
+import xarray as xr
+
+import tcitool
+import tcitool.func as tf
+import tcitool.calc.argonne_kernels as ak
+from tcitool.calc.wbgt_argonne import WBGT_ArgonneCalculator
+
+class ArgonneLookupTable(object):
+    """Lookup table of the globe (Tg) and natural wet bulb (Tnw) temperature of
+    the Argonne model.
+
+    The residuals of the Argonne model depend on the 10 input parameters
+    (t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal) only
+    through 6 combinations: t2m, rh, dskt (skt - t2m), ws, P_kPa and the
+    absorbed solar radiation Q (which is different for the globe and the
+    wick, see reduce). The table holds the exact solution (minus t2m) on a
+    regular grid of these 6 axes, and is evaluated by multilinear
+    interpolation (see interpolate). Points outside of the grid evaluate to
+    NaN.
+
+    After building, the table is compared with the exact solver on random
+    points within the grid (see validate). The maximum and RMS error are kept
+    in self.error, and are saved with the table.
+
+    Attributes:
+        axes: a dict of the axis names to 1D np.arrays of the grid values
+        tables: a dict with the arrays of Tg - t2m and Tnw - t2m [K], of the
+            shape of the grid
+        error: a dict with the 'max' and 'rms' error [K] of Tg and Tnw
+    """
+    AXES = ('t2m','rh','dskt','ws','P_kPa','Q')
+    DEFAULT_AXES = {
+        't2m': tf.u.tempC2K(np.arange(-40.,55.,5.)),
+        'rh': np.array([0.01,0.02,0.05,0.1,0.15,0.2,0.3,0.4,0.5,0.6,0.7,0.8,
+                        0.9,1.]),
+        'dskt': np.arange(-20.,45.,10.),
+        'ws': np.array([0.1,0.15,0.2,0.3,0.4,0.5,0.65,0.8,1.,1.25,1.5,2.,2.5,
+                        3.,4.,5.,6.5,8.,12.,20.]),
+        'P_kPa': np.array([60.,80.,95.,105.]),
+        'Q': np.r_[0.:200.:12.5,200.:1000.:50.,1000.:2001.:100.],
+    }
+    BATCH = 65536
+
+    def __init__(self,axes,tables,error=None):
+        self.axes = {name: np.asarray(axes[name],dtype=float)
+                     for name in self.AXES}
+        self.tables = {key: np.asarray(tables[key],dtype=float)
+                       for key in ('Tg','Tnw')}
+        self.error = {} if error is None else error
+
+    @classmethod
+    def reduce(cls,tg_or_tnw,params):
+        """Reduces the 10 input parameters of the Argonne model to the 6 axes
+        of the table.
+
+        Args:
+            tg_or_tnw: 'Tg' or 'Tnw'
+            params: a sequence of the 10 input parameters (np.arrays)
+
+        Returns:
+            A tuple of np.arrays (t2m, rh, dskt, ws, P_kPa, Q)
+        """
+        t2m, skt, rh, e_kPa, P_kPa, ws, Isw_in, Isw_frac, solcza, fal = params
+        with np.errstate(all='ignore'):
+            if tg_or_tnw == 'Tg':
+                Q = Isw_in*(Isw_frac*(1./(2.*solcza) - 1.) + 1. + fal)
+            else:
+                ratio = 0.25*ak.D_WICK/ak.L_WICK
+                Q = Isw_in*((1. - Isw_frac)*(1. + ratio)
+                    + Isw_frac*(np.tan(np.arccos(solcza))/np.pi + ratio)
+                    + fal)
+            Q = np.where(Isw_in==0,0.,Q)
+        return t2m, rh, skt - t2m, ws, P_kPa, Q
+
+    @classmethod
+    def expand(cls,tg_or_tnw,t2m,rh,dskt,ws,P_kPa,Q):
+        """Returns a set of the 10 input parameters of the Argonne model, that
+        reduces to the given axis values (see reduce)."""
+        t2m, rh, dskt, ws, P_kPa, Q = np.broadcast_arrays(
+            t2m,rh,dskt,ws,P_kPa,Q)
+        e_kPa = rh*tf.m.saturated_vapor_pressure(t2m)
+        if tg_or_tnw == 'Tg':
+            Isw_in = Q
+        else:
+            Isw_in = Q/(1. + 0.25*ak.D_WICK/ak.L_WICK)
+        zeros, ones = np.zeros_like(t2m), np.ones_like(t2m)
+        return (t2m, t2m + dskt, rh, e_kPa, P_kPa, ws, Isw_in, zeros, ones,
+                zeros)
+
+    @classmethod
+    def solve(cls,tg_or_tnw,params,lim,xtol=0.01,maxiter=100):
+        """Solves Tg or Tnw exactly, using the kernels of
+        tcitool.calc.argonne_kernels, over the lim range [K]. The upper limit
+        of Tnw is capped below the boiling point at P_kPa, where the residual
+        of the wet bulb is not defined."""
+        if tg_or_tnw == 'Tg':
+            return ak.solve_tg(lim[0],lim[1],xtol,maxiter,*params)
+        upper = np.fmin(lim[1],tf.m.dewpoint(params[4]) - 0.1)
+        return ak.solve_tnw(lim[0],upper,xtol,maxiter,*params)
+
+    @classmethod
+    def build(cls,axes=None,Tg_lim=(-60,120),Tnw_lim=(-60,90),xtol=0.01,
+              maxiter=100,validate=10000):
+        """Builds a lookup table, by solving the Argonne model on every grid
+        point.
+
+        Args:
+            axes: optional dict of axis names to grid values, replacing the
+                DEFAULT_AXES
+            Tg_lim, Tnw_lim: the search range of the solver [deg C]
+            xtol: absolute tolerance of the solver [K]
+            maxiter: maximum number of iterations of the solver
+            validate: number of random points used to estimate the error of
+                the table (see validate), 0 to skip
+
+        Returns:
+            an ArgonneLookupTable
+        """
+        axes = dict(cls.DEFAULT_AXES,**({} if axes is None else axes))
+        grid = np.meshgrid(*(axes[name] for name in cls.AXES),indexing='ij')
+        tables = {}
+        for tg_or_tnw, lim in (('Tg',Tg_lim),('Tnw',Tnw_lim)):
+            params = cls.expand(tg_or_tnw,*grid)
+            tables[tg_or_tnw] = cls.solve(
+                tg_or_tnw,params,tf.u.tempC2K(np.array(lim,dtype=float)),
+                xtol,maxiter) - grid[0]
+        lut = cls(axes,tables)
+        if validate:
+            lut.validate(validate,Tg_lim=Tg_lim,Tnw_lim=Tnw_lim,xtol=xtol,
+                         maxiter=maxiter)
+        return lut
+
+    def validate(self,samples=10000,seed=0,Tg_lim=(-60,120),Tnw_lim=(-60,90),
+                 xtol=0.01,maxiter=100):
+        """Estimates the error of the table, by comparing it with the exact
+        solver on random points, drawn uniformly within the grid.
+
+        Returns:
+            A dict with the 'max' and 'rms' error [K] of Tg and Tnw, which is
+            also stored in self.error
+        """
+        rng = np.random.default_rng(seed)
+        point = tuple(rng.uniform(self.axes[name][0],self.axes[name][-1],
+                                  samples)
+                      for name in self.AXES)
+        for tg_or_tnw, lim in (('Tg',Tg_lim),('Tnw',Tnw_lim)):
+            params = self.expand(tg_or_tnw,*point)
+            exact = self.solve(tg_or_tnw,params,
+                tf.u.tempC2K(np.array(lim,dtype=float)),xtol,maxiter)
+            diff = self.evaluate(tg_or_tnw,params) - exact
+            diff = diff[np.isfinite(diff)]
+            self.error[tg_or_tnw] = {
+                'max': float(np.max(np.abs(diff))),
+                'rms': float(np.sqrt(np.mean(diff**2))),
+                'samples': int(diff.size)}
+        return self.error
+
+    def evaluate(self,tg_or_tnw,params):
+        """Evaluates Tg or Tnw [K] from the table.
+
+        Args:
+            tg_or_tnw: 'Tg' or 'Tnw'
+            params: a sequence of the 10 input parameters (np.arrays)
+
+        Returns:
+            An np.array of Tg or Tnw, NaN for points outside of the table
+        """
+        reduced = np.broadcast_arrays(*self.reduce(tg_or_tnw,params))
+        values = self.interpolate(tg_or_tnw,
+            [arr.ravel() for arr in reduced]).reshape(reduced[0].shape)
+        return values + reduced[0]
+
+    def interpolate(self,tg_or_tnw,points):
+        """Multilinear interpolation of the table of Tg or Tnw.
+
+        The points are processed in batches of BATCH points. For every batch,
+        the values at the 2^6 corners of the enclosing grid cells are
+        gathered from the flattened table, and reduced by linear
+        interpolation along one axis after the other.
+
+        Args:
+            tg_or_tnw: 'Tg' or 'Tnw'
+            points: a list of 1D np.arrays, the values along each of the AXES
+
+        Returns:
+            A 1D np.array of the interpolated values (Tg - t2m or Tnw - t2m),
+            NaN outside of the table
+        """
+        table = self.tables[tg_or_tnw]
+        flat = table.ravel()
+        strides = np.array(table.strides)//table.itemsize
+        corners = np.array([np.dot(corner,strides) for corner in
+                            itertools.product((0,1),repeat=table.ndim)])
+        result = np.empty(points[0].size)
+        for start in range(0,result.size,self.BATCH):
+            batch = slice(start,start+self.BATCH)
+            index = 0
+            weights = []
+            outside = np.zeros(result[batch].shape,dtype=bool)
+            for name, stride, x in zip(self.AXES,strides,points):
+                axis, x = self.axes[name], x[batch]
+                i = np.clip(np.searchsorted(axis,x,side='right') - 1,
+                            0,axis.size - 2)
+                weights.append((x - axis[i])/(axis[i+1] - axis[i]))
+                index = index + i*stride
+                outside |= ~((x>=axis[0]) & (x<=axis[-1]))
+            values = flat[index[np.newaxis,:] + corners[:,np.newaxis]]
+            values = values.reshape((2,)*table.ndim + (-1,))
+            for weight in weights:
+                values = values[0] + (values[1] - values[0])*weight
+            values[outside] = np.nan
+            result[batch] = values
+        return result
+
+    def save(self,path):
+        """Saves the table as .npz, or as NetCDF when the path ends with .nc.
+        The tables are stored in single precision."""
+        if os.path.splitext(path)[1] == '.nc':
+            self.to_dataset().to_netcdf(path)
+            return
+        errors = {'error_%s_%s'%(key,stat): value
+                  for key, error in self.error.items()
+                  for stat, value in error.items()}
+        np.savez_compressed(path,
+            **{'axis_'+name: self.axes[name] for name in self.AXES},
+            **{key: table.astype(np.float32)
+               for key, table in self.tables.items()},
+            **errors)
+
+    @classmethod
+    def load(cls,path):
+        """Loads a table saved with save (.npz or .nc)"""
+        if os.path.splitext(path)[1] == '.nc':
+            with xr.open_dataset(path) as ds:
+                return cls.from_dataset(ds.load())
+        with np.load(path) as npz:
+            axes = {name: npz['axis_'+name] for name in cls.AXES}
+            tables = {key: npz[key] for key in ('Tg','Tnw')}
+            error = {}
+            for name in npz.files:
+                if name.startswith('error_'):
+                    key, stat = name[len('error_'):].split('_')
+                    error.setdefault(key,{})[stat] = npz[name].item()
+        return cls(axes,tables,error)
+
+    def to_dataset(self):
+        """Returns the table as an xarray.Dataset"""
+        ds = xr.Dataset(
+            {key: (self.AXES,table.astype(np.float32))
+             for key, table in self.tables.items()},
+            coords=self.axes)
+        for key, error in self.error.items():
+            ds[key].attrs.update({'error_'+stat: value
+                                  for stat, value in error.items()})
+            ds[key].attrs['units'] = 'K'
+            ds[key].attrs['long_name'] = '%s - t2m'%key
+        return ds
+
+    @classmethod
+    def from_dataset(cls,ds):
+        """Creates a table from an xarray.Dataset, see to_dataset"""
+        error = {key: {attr[len('error_'):]: np.asarray(value).item()
+                       for attr, value in ds[key].attrs.items()
+                       if attr.startswith('error_')}
+                 for key in ('Tg','Tnw')}
+        return cls({name: ds[name].values for name in cls.AXES},
+                   {key: ds[key].transpose(*cls.AXES).values
+                    for key in ('Tg','Tnw')},
+                   {key: value for key, value in error.items() if value})
+
+class WBGT_ArgonneLUTCalculator(WBGT_ArgonneCalculator):
+    """Calculates the WBGT of the Argonne model from a precomputed lookup
+    table (see ArgonneLookupTable), instead of solving the energy balances.
+
+    The table is taken from the 'table' hyperparameter or from
+    tool.options['argonne_lut'], either as an ArgonneLookupTable or as the
+    path of a saved table. Grid points outside of the table are solved
+    exactly, unless the 'lut_fallback' hyperparameter is False (these are
+    then set to NaN). The error of the table is added to the attributes of
+    tg and tnw.
+    """
+    def __init__(self,tool,**kwargs):
+        super().__init__(tool,**kwargs)
+        self.export_params = {'wbgt':'wbgt_argonne_lut',
+                              'tg':'tg_argonne_lut',
+                              'tnw':'tnw_argonne_lut'}
+        self.lut = None
+
+    def preface(self):
+        super().preface()
+        self.lut = self.lookup_table()
+
+    def default_hyperparams(self):
+        super().default_hyperparams()
+        if 'lut_fallback' not in self.hyperparams:
+            self.hyperparams['lut_fallback'] = True
+
+    def lookup_table(self):
+        table = self.hyperparams.get('table',
+            self.tool.options.get('argonne_lut'))
+        if table is None:
+            raise tcitool.MissingDataError(
+                "The %s needs a lookup table, set tool.options['argonne_lut']"
+                " to an ArgonneLookupTable or to the path of a saved table."%(
+                self.name))
+        if isinstance(table,ArgonneLookupTable):
+            return table
+        return ArgonneLookupTable.load(table)
+
+    def optimize_block(self,data):
+        """Evaluates Tg and Tnw for a block of data from the lookup table.
+
+        Args:
+            data: an np.array with the 10 input parameters along axis 0
+
+        Returns:
+            A tuple of np.arrays (tg, tnw) of shape data.shape[1:]
+        """
+        skip = self.daytime_mask(data)
+        solve = ~skip
+        results = []
+        for tg_or_tnw in ('Tg','Tnw'):
+            result = np.full(data.shape[1:],np.nan)
+            params = data[:,solve]
+            values = self.lut.evaluate(tg_or_tnw,params)
+            outside = np.isnan(values) & np.all(np.isfinite(params),axis=0)
+            if outside.any() and self.hyperparams['lut_fallback']:
+                values[outside] = self.optimize_points(tg_or_tnw,
+                    params[:,outside],
+                    np.zeros(np.count_nonzero(outside),dtype=bool))
+            result[solve] = values
+            stats = self.solver_stats.setdefault(tg_or_tnw,
+                {'points': 0, 'fallback': 0, 'unsolved': 0})
+            stats['lut'] = (stats.get('lut',0) +
+                            values.size - int(np.count_nonzero(outside)))
+            stats['lut_outside'] = (stats.get('lut_outside',0) +
+                                    int(np.count_nonzero(outside)))
+            results.append(result)
+        return tuple(results)
+
+    def closing_calculations(self):
+        super().closing_calculations()
+        for tg_or_tnw, key in (('Tg','tg'),('Tnw','tnw')):
+            self.data[key].attrs['long_name'] += ', from a lookup table'
+            for stat, value in self.lut.error.get(tg_or_tnw,{}).items():
+                self.data[key].attrs['lut_error_'+stat] = value
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['lut'] = self.lut
+        return state
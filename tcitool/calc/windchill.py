@@ -1,4 +1,5 @@
 import tcitool
+import tcitool.calc.approx_kernels as apk
 
 class WindChill_JAGTICalculator(tcitool.Calculator):
     def __init__(self,tool):
@@ -7,12 +8,9 @@ class WindChill_JAGTICalculator(tcitool.Calculator):
         self.require_data('t2m','ws10')
 
     def main(self):
-        t2mC = self.tool.data.get('t2mC',
-            tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
-        wind_at_15dm = (3.6*self.tool.data['ws10'])**0.16
-        wcet = 13.12 + 0.6215 * t2mC \
-                     - 11.37 * wind_at_15dm \
-                     + 0.3965 * t2mC * wind_at_15dm
+        t2mC = self.intermediate('t2mC',
+            lambda: tcitool.UnitFuncs.tempK2C(self.tool.data['t2m']))
+        wcet = apk.apply(apk.jagti,t2mC,self.tool.data['ws10'])
         wcet.attrs.update({
             'units': 'deg C',
             'long_name': 'Wind Chill Equivalent Temperature (using JAG/TI '
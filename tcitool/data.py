@@ -1,6 +1,25 @@
+import collections
+import glob
+import os
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
 import xarray as xr
 
 class DataStore(object):
+    """
+    Attributes:
+        chunk_plan: the chunk sizes chosen by plan_chunks for the last lazy
+            load, or None
+        derived: an OrderedDict of the variables made by generators, to the
+            variables they were generated from, in least recently used order
+        borrowed: the names of the variables whose arrays belong to the
+            caller (e.g. of a Dataset passed to load), see owns
+        persisted: the names of the dask variables computed by persist
+    """
+    max_chunk_bytes = 256*2**20
+
     def __init__(self,file_or_xarray=None,**kwargs):
         """Inits this DataStore
 
@@ -10,6 +29,10 @@ class DataStore(object):
             **kwargs: will be passed to xarray.open_dataset
         """
         self._ds = None
+        self.chunk_plan = None
+        self.derived = collections.OrderedDict()
+        self.borrowed = set()
+        self.persisted = set()
         if file_or_xarray is not None:
             self.load(file_or_xarray,**kwargs)
 
@@ -65,17 +88,23 @@ class DataStore(object):
         return locals()
     chunks = property(**chunks())
 
-    def __getitem__(self,*args,**kwargs):
+    def __getitem__(self,key):
         """Alias for xarray.Dataset.__getitem__"""
-        return self.ds.__getitem__(*args,**kwargs)
+        if isinstance(key, str) and key in self.derived:
+            self.derived.move_to_end(key)
+        return self.ds.__getitem__(key)
 
     def __setitem__(self,*args,**kwargs):
         """Alias for xarray.Dataset.__setitem__"""
+        if len(args) > 0 and isinstance(args[0], str):
+            self.persisted.discard(args[0])
         return self.ds.__setitem__(*args,**kwargs)
 
-    def __delitem__(self,*args,**kwargs):
+    def __delitem__(self,key):
         """Alias for xarray.Dataset.__delitem__"""
-        return self.ds.__delitem__(*args,**kwargs)
+        self.derived.pop(key,None)
+        self.persisted.discard(key)
+        return self.ds.__delitem__(key)
 
     def __contains__(self,*args,**kwargs):
         """Alias for xarray.Dataset.__contains__"""
@@ -84,19 +113,174 @@ class DataStore(object):
     def get(self,key,default):
         return self.ds[key] if key in self else default
 
-    def load(self,file_or_xarray,**kwargs):
-        """Loads data form a xarray or file
+    def owns(self,key):
+        """True if the array of the variable key may be modified in place,
+        i.e. it was not passed in by the caller (see borrowed)"""
+        return key not in self.borrowed
+
+    def load(self,file_or_xarray,lazy=False,memory_limit=None,verbose=True,
+             **kwargs):
+        """Loads data form a xarray or file(s)
 
         Args:
             filename_or_xarray: A file path describing the location of the file
-            to be loaded (if string), or a xarray.Dataset containing the data.
+            to be loaded (if string), a glob pattern or list of file paths
+            (see load_files), or a xarray.Dataset containing the data.
+            lazy: if True, the file is opened as dask arrays, with the chunk
+                sizes chosen by plan_chunks (unless chunks is given in kwargs)
+            memory_limit: the memory (in bytes) plan_chunks may plan for,
+                default: the available memory
+            verbose: if True, the chunk plan is printed
             **kwargs: will be passed to xarray.open_dataset
         """
-        self.ds = ( file_or_xarray
+        if isinstance(file_or_xarray, (list, tuple)) or (
+                isinstance(file_or_xarray, str) and
+                glob.has_magic(file_or_xarray)):
+            self.load_files(file_or_xarray,lazy=lazy,memory_limit=memory_limit,
+                            verbose=verbose,**kwargs)
+            return
+        if self.is_zarr(file_or_xarray):
+            kwargs.setdefault('engine','zarr')
+        if (lazy and not isinstance(file_or_xarray, xr.Dataset) and
+                'chunks' not in kwargs):
+            kwargs['chunks'] = self.plan_chunks(
+                file_or_xarray,memory_limit,verbose)
+        # a shallow copy, so generated variables are not added to the
+        # caller's Dataset
+        self.ds = ( file_or_xarray.copy(deep=False)
                     if isinstance(file_or_xarray, xr.Dataset)
                     else xr.open_dataset(file_or_xarray,**kwargs))
+        self.borrowed = (set(file_or_xarray.variables)
+                         if isinstance(file_or_xarray, xr.Dataset) else set())
+        self.persisted = set()
+        self.transpose_default()
+
+    def load_files(self,paths,identical_coords=True,lazy=False,
+                   memory_limit=None,verbose=True,**kwargs):
+        """Loads a time series, stored in multiple files (e.g. one per month),
+        as one lazy xarray.Dataset
+
+        The files are opened in parallel (using xarray.open_mfdataset) and
+        concatenated along time, in the order of their (sorted) file names.
+        The time coordinate is sorted afterwards, if needed.
+
+        Args:
+            paths: a glob pattern, or a list of file paths
+            identical_coords: if True, all coordinates except time are taken
+                from the first file, without checking the other files
+            lazy: if True, the chunk sizes are chosen by plan_chunks, for the
+                first file (unless chunks is given in kwargs)
+            memory_limit: see load
+            verbose: see load
+            **kwargs: will be passed to xarray.open_mfdataset
+        """
+        paths = sorted(glob.glob(paths) if isinstance(paths, str) else paths)
+        if len(paths) == 0:
+            raise FileNotFoundError('No files to load')
+        if lazy and 'chunks' not in kwargs:
+            kwargs['chunks'] = self.plan_chunks(paths[0],memory_limit,verbose)
+        mf_kwargs = {'combine': 'nested', 'concat_dim': 'time',
+                     'parallel': True, 'data_vars': 'minimal',
+                     'coords': 'minimal', 'compat': 'override'}
+        if identical_coords:
+            mf_kwargs['join'] = 'override'
+        mf_kwargs.update(kwargs)
+        ds = xr.open_mfdataset(paths,**mf_kwargs)
+        if not ds.indexes['time'].is_monotonic_increasing:
+            ds = ds.sortby('time')
+        self.ds = ds
+        self.borrowed = set()
+        self.persisted = set()
         self.transpose_default()
 
+    def plan_chunks(self,filepath,memory_limit=None,verbose=True):
+        """Chooses dask chunk sizes to open a (large) NetCDF file with
+
+        The time axis is kept in one chunk where possible, as the
+        de-accumulation of cumulative variables works along time (see
+        IntegratedVarsGenerators.cumulatives2regular): the other dimensions
+        are split first. They are chunked in multiples of the on-disk
+        NetCDF/HDF5 chunks, so no on-disk chunk is read by more than one dask
+        chunk. Contiguous (unchunked) variables may be split anywhere. Only
+        when the smallest of these chunks is still too large, the time axis
+        is split. A chunk is at most max_chunk_bytes, and at most the
+        memory_limit divided over 4 chunks per CPU.
+
+        Args:
+            filepath: path of the NetCDF file
+            memory_limit: the memory (in bytes) to plan for, default: the
+                available memory
+            verbose: if True, the plan is printed
+
+        Returns:
+            A dict of dimension names to chunk sizes, to be passed as chunks
+            to xarray.open_dataset
+        """
+        engine = 'zarr' if self.is_zarr(filepath) else None
+        with xr.open_dataset(filepath,engine=engine) as ds:
+            sizes = dict(ds.sizes)
+            disk = {dim: 1 for dim in sizes}
+            itemsize = 1
+            for key in ds.data_vars:
+                var = ds[key]
+                itemsize = max(itemsize,var.dtype.itemsize)
+                # contiguous variables can be sliced along every dimension
+                ondisk = (var.encoding.get('chunksizes') or
+                          var.encoding.get('chunks') or (1,)*var.ndim)
+                for dim, size in zip(var.dims,ondisk):
+                    disk[dim] = max(disk[dim],size)
+        if memory_limit is None:
+            memory_limit = self.available_memory()
+        target = max(min(self.max_chunk_bytes,
+                         memory_limit//(4*cpu_count())),itemsize)
+
+        chunks = {dim: (sizes[dim] if dim=='time' else disk[dim])
+                  for dim in sizes}
+        def nbytes():
+            return int(np.prod(list(chunks.values())))*itemsize
+        while nbytes() > target:
+            # the other dimensions down to their on-disk chunks first, then
+            # time, then splitting the on-disk chunks
+            candidates = ([dim for dim in chunks
+                           if dim!='time' and chunks[dim] > disk[dim]] or
+                          [dim for dim in chunks
+                           if dim=='time' and chunks[dim] > disk[dim]] or
+                          [dim for dim in chunks if chunks[dim] > 1])
+            if len(candidates) == 0:
+                break
+            dim = max(candidates,key=chunks.get)
+            step = disk[dim] if chunks[dim] > disk[dim] else 1
+            chunks[dim] = max(step,(chunks[dim]//2)//step*step)
+        grown = True
+        while grown:
+            grown = False
+            for dim in sorted(chunks,key=chunks.get):
+                if chunks[dim] < sizes[dim] and nbytes()*2 <= target:
+                    chunks[dim] = min(sizes[dim],chunks[dim]*2)
+                    grown = True
+
+        self.chunk_plan = chunks
+        if verbose:
+            nchunks = int(np.prod([-(-sizes[dim]//chunks[dim])
+                                   for dim in sizes]))
+            print('Chunk plan for %s (%.0f MiB available):'%(
+                os.path.basename(filepath),memory_limit/2**20))
+            for dim in sizes:
+                print('    %-10s %8d in chunks of %-8d (on disk %d)'%(
+                    dim,sizes[dim],chunks[dim],disk[dim]))
+            print('    %d chunks of %.1f MiB per variable'%(
+                nchunks,nbytes()/2**20))
+        return chunks
+
+    @staticmethod
+    def available_memory():
+        """The available memory in bytes (using psutil if installed)"""
+        try:
+            import psutil
+            return psutil.virtual_memory().available
+        except ImportError:
+            return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
     def load_harmonie(self,file_or_xarray,**kwargs):
         ds = ( file_or_xarray
                if isinstance(file_or_xarray, xr.Dataset)
@@ -117,10 +301,118 @@ class DataStore(object):
                          'r': 'rh'})
         ds['skt'] = ds['t2m']
         self.ds = ds
+        self.borrowed = (set(ds.variables)
+                         if isinstance(file_or_xarray, xr.Dataset) else set())
+        self.persisted = set()
+
+    @staticmethod
+    def is_zarr(filepath):
+        """True if filepath is (to be) a Zarr store, i.e. ends with .zarr"""
+        return (isinstance(filepath, str) and
+                filepath.rstrip('/'+os.sep).endswith('.zarr'))
+
+    def save(self,filepath,variables=None,append_dim=None,complevel=None,
+             verbose=True,**kwargs):
+        """Saves (a part of) the data to a NetCDF file or Zarr store
+
+        A filepath ending with .zarr is written as Zarr store, other paths as
+        NetCDF file.
 
-    def save(self,filepath,**kwargs):
-        kwargs.update({'path':filepath})
-        self.ds.to_netcdf(**kwargs)
+        Args:
+            filepath: the path of the file or store
+            variables: optional list of variables to save. If the file or
+                store exists, these variables are added to it, without
+                rewriting the variables already there.
+            append_dim: optional dimension (e.g. 'time') along which the data
+                is appended to an existing Zarr store, for new time steps
+            complevel: optional compression level (1-9). Every variable is
+                then compressed, chunked like its dask chunks (or the chunk
+                size of the DataStore). Variables already in the file or
+                store keep their encoding when appending.
+            verbose: if True, the size and write throughput are printed
+            **kwargs: will be passed to xarray.Dataset.to_netcdf or to_zarr
+
+        Returns:
+            The number of bytes of data written
+        """
+        ds = self.ds if variables is None else self.ds[list(variables)]
+        exists = os.path.exists(filepath)
+        zarr = self.is_zarr(filepath)
+        if append_dim is not None:
+            if not zarr:
+                raise ValueError("append_dim is only supported for Zarr "
+                                 "stores (*.zarr)")
+            kwargs.update({'append_dim':append_dim})
+        elif variables is not None and exists:
+            kwargs.setdefault('mode','a')
+        if complevel is not None:
+            encoding = self.save_encoding(ds,complevel,zarr)
+            if exists and (append_dim is not None or kwargs.get('mode')=='a'):
+                # the encoding of stored variables can not be changed
+                stored = self.stored_variables(filepath)
+                encoding = {key: enc for key, enc in encoding.items()
+                            if key not in stored}
+            kwargs.setdefault('encoding',encoding)
+        start = time.perf_counter()
+        if zarr:
+            ds.to_zarr(filepath,**kwargs)
+        else:
+            ds.to_netcdf(filepath,**kwargs)
+        duration = time.perf_counter()-start
+        if verbose:
+            print('Written %.1f MiB of data (%d variables) to %s in %.1fs '
+                  '(%.1f MiB/s), %.1f MiB on disk'%(
+                ds.nbytes/2**20,len(ds.data_vars),filepath,duration,
+                ds.nbytes/2**20/max(duration,1e-9),
+                self.disk_size(filepath)/2**20))
+        return ds.nbytes
+
+    def save_encoding(self,ds,complevel,zarr=False):
+        """The encoding to compress every variable of ds with, for save"""
+        chunk_size = self.get_chunk_size()
+        encoding = {}
+        for key in ds.data_vars:
+            var = ds[key]
+            chunks = (tuple(c[0] for c in var.chunks)
+                      if var.chunks is not None
+                      else tuple(min(chunk_size.get(dim,size),size)
+                                 for dim, size in zip(var.dims,var.shape)))
+            if zarr:
+                encoding[key] = self.zarr_compression(complevel)
+            else:
+                encoding[key] = {'zlib': True, 'complevel': complevel,
+                                 'shuffle': var.dtype.kind in 'fiu',
+                                 'chunksizes': chunks}
+            if zarr and var.chunks is None:
+                encoding[key]['chunks'] = chunks
+        return encoding
+
+    @staticmethod
+    def zarr_compression(complevel):
+        """The encoding to compress a Zarr variable with Blosc (zstd)"""
+        import zarr
+        if int(zarr.__version__.split('.')[0]) >= 3:
+            import zarr.codecs
+            return {'compressors': (zarr.codecs.BloscCodec(
+                cname='zstd',clevel=complevel,shuffle='bitshuffle'),)}
+        import numcodecs
+        return {'compressor': numcodecs.Blosc(
+            cname='zstd',clevel=complevel,shuffle=numcodecs.Blosc.BITSHUFFLE)}
+
+    @classmethod
+    def stored_variables(cls,filepath):
+        """The names of the variables in an existing file or Zarr store"""
+        engine = 'zarr' if cls.is_zarr(filepath) else None
+        with xr.open_dataset(filepath,engine=engine) as ds:
+            return set(ds.variables)
+
+    @staticmethod
+    def disk_size(filepath):
+        """The size in bytes of a file, or of all files in a (Zarr) directory"""
+        if not os.path.isdir(filepath):
+            return os.path.getsize(filepath)
+        return sum(os.path.getsize(os.path.join(root,name))
+                   for root, _, names in os.walk(filepath) for name in names)
 
     def buffer(self,filepath,save_kwargs=None,load_kwargs=None):
         if save_kwargs is None:
@@ -133,19 +425,53 @@ class DataStore(object):
             raise TypeError("'load_kwargs' must be a dictionary")
 
         self.save(filepath,**save_kwargs)
-        self.load(filepath,**save_kwargs)
+        self.load(filepath,**load_kwargs)
 
     def merge(self,datastore_or_xarray):
-        """Merge with an other DataStore or xarray.Dataset"""
+        """Merge with an other DataStore or xarray.Dataset
+
+        When both have identical coordinates, the variables are added without
+        aligning the datasets (xarray.merge)."""
         if isinstance(datastore_or_xarray,DataStore):
-            self.ds = xr.merge([self.ds,datastore_or_xarray.ds])
+            other = datastore_or_xarray.ds
         elif isinstance(datastore_or_xarray,xr.Dataset):
-            self.ds = xr.merge([self.ds,datastore_or_xarray])
+            other = datastore_or_xarray
         else:
             raise TypeError("datastore_or_xarray must be a DataStore or "
                             "xarray.Dataset")
+        if self.has_identical_coords(other):
+            self.assign_variables(other)
+            return
+        self.borrowed.update(other.variables)
+        self.ds = xr.merge([self.ds,other])
         self.transpose_default()
 
+    def assign_variables(self,other):
+        """Adds the variables of the xarray.Dataset other, without aligning
+        them, if other has identical coordinates (e.g. a Dataset made with
+        copy_empty). Only the new variables are transposed to the default
+        order. Falls back to merge otherwise."""
+        if not self.has_identical_coords(other):
+            self.merge(other)
+            return
+        order = self.default_order(other)
+        self.borrowed.update(other.data_vars)
+        for key in other.data_vars:
+            var = other[key].variable
+            if order is not None:
+                var_order = [dim for dim in order if dim in var.dims]
+                if list(var.dims) != var_order:
+                    var = var.transpose(*var_order)
+            self.ds[key] = var
+
+    def has_identical_coords(self,other):
+        """True if the xarray.Dataset other has the same dimension coordinates
+        as this DataStore"""
+        indexes = self.ds.indexes
+        return (set(indexes.keys()) == set(other.indexes.keys()) and
+                all(indexes[dim].equals(other.indexes[dim])
+                    for dim in indexes.keys()))
+
     def copy_empty(self):
         return self.ds.coords.to_dataset()
 
@@ -161,23 +487,100 @@ class DataStore(object):
         return coordxarray_md
 
     def get_chunk_size(self):
-        return {coord: chunks[0] for coord, chunks in self.ds.chunks.items()}
+        """The (largest) chunk size per dimension, also when the variables are
+        chunked differently"""
+        chunk_size = {}
+        for key in self.ds.data_vars:
+            if self.ds[key].chunks is None:
+                continue
+            for dim, chunks in zip(self.ds[key].dims,self.ds[key].chunks):
+                chunk_size[dim] = max(chunk_size.get(dim,0),chunks[0])
+        return chunk_size
 
     def refresh_chunks(self):
         if self.get_chunk_size():
             self.ds = self.ds.chunk(self.get_chunk_size())
 
 
-    def persist(self):
-        self._ds.persist()
+    def persist(self,variables=None,memory_budget=None):
+        """Computes lazy (dask) variables and keeps them in memory
 
-    def transpose_default(self,preferd_order=None):
+        Args:
+            variables: optional list of the variables to compute (e.g. the
+                results of calculators), default: all variables. With a
+                memory_budget, the derived variables are computed as well.
+                The other variables (e.g. inputs opened lazily) stay lazy.
+            memory_budget: optional number of bytes the variables in memory
+                may use. When exceeded, derived variables are evicted (see
+                evict).
+        """
+        if variables is None:
+            keys = list(self.ds.data_vars)
+        else:
+            keys = list(variables)
+            if memory_budget is not None:
+                keys += list(self.derived)
+        lazy = [key for key in dict.fromkeys(keys)
+                if key in self.ds.data_vars and self.ds[key].chunks is not None]
+        if len(lazy) > 0:
+            persisted = self.ds[lazy].persist()
+            for key in lazy:
+                self.ds[key] = persisted[key].variable
+            self.persisted.update(lazy)
+        if memory_budget is not None:
+            self.evict(memory_budget)
+
+    def mark_derived(self,key,requires):
+        """Marks the variable key as generated from the variables requires,
+        so it may be evicted and generated again later (see evict)"""
+        self.derived[key] = list(requires)
+        self.derived.move_to_end(key)
+
+    def evict(self,memory_budget):
+        """Deletes the least recently used derived variables, until the
+        variables in memory use at most memory_budget bytes. The dask
+        variables computed by persist are counted as well, the other dask
+        variables are not (they are not in memory).
+
+        Only derived variables that were generated from non-derived
+        variables still in the DataStore are evicted, so they can always be
+        generated again from the data that is kept.
+
+        Returns:
+            The list of evicted variables
+        """
+        in_memory = {key: self.ds[key].nbytes for key in self.ds.data_vars
+                     if self.ds[key].chunks is None or key in self.persisted}
+        used = sum(in_memory.values())
+        evicted = []
+        for key, requires in list(self.derived.items()):
+            if used <= memory_budget:
+                break
+            if (key in in_memory and
+                    not any(req in self.derived for req in requires) and
+                    all(req in self.ds for req in requires)):
+                del self[key]
+                used -= in_memory[key]
+                evicted.append(key)
+        return evicted
+
+    def default_order(self,ds=None,preferd_order=None):
+        """The preferd order of dimensions, if it applies to (the coordinates
+        of) ds (default: this DataStore), or else None"""
+        ds = self.ds if ds is None else ds
         preferd_order = (['time','longitude','latitude']
                          if preferd_order is None
                          else preferd_order)
-        if (len(self.ds.coords)==len(preferd_order) and
-                all(coord in self.ds.coords for coord in preferd_order)):
-            self.ds = self.ds.transpose(*preferd_order)
+        if (len(ds.coords)==len(preferd_order) and
+                all(coord in ds.coords for coord in preferd_order)):
+            return tuple(preferd_order)
+        return None
+
+    def transpose_default(self,preferd_order=None):
+        order = self.default_order(preferd_order=preferd_order)
+        if (order is not None and
+                any(self.ds[key].dims != order for key in self.ds.data_vars)):
+            self.ds = self.ds.transpose(*order)
 
     def table_repr(self):
         table_shape = [2,4,5,9,5]
@@ -7,3 +7,8 @@ class UnknownCalculatorWarning(UserWarning):
     """Warning generated when a calculation is requested, but the calculator is
     not found"""
     pass
+
+class SolverWarning(UserWarning):
+    """Warning generated when the optimizer could not find a solution for (some
+    of) the data points"""
+    pass
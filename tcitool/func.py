@@ -10,37 +10,37 @@ class UnitFuncs(object):
         """Converts a degree,minute,seconds to radians"""
         return np.deg2rad(cls.dms2deg(d,m,s))
     @classmethod
-    def tempC2K(cls,temp_C):
+    def tempC2K(cls,temp_C,out=None):
         """Converts a temperature in Celcius to Kelvin"""
-        return temp_C + 273.15
+        return np.add(temp_C,273.15,out=out)
     @classmethod
-    def tempK2C(cls,temp_K):
+    def tempK2C(cls,temp_K,out=None):
         """Converts a temperature in Kelvin to Celcius"""
-        return temp_K - 273.15
+        return np.subtract(temp_K,273.15,out=out)
     @classmethod
-    def presPa2hPa(cls,p_Pa):
-        return p_Pa/100
+    def presPa2hPa(cls,p_Pa,out=None):
+        return np.divide(p_Pa,100,out=out)
     @classmethod
-    def presPa2kPa(cls,p_Pa):
-        return p_Pa/1000
+    def presPa2kPa(cls,p_Pa,out=None):
+        return np.divide(p_Pa,1000,out=out)
     @classmethod
-    def preshPa2Pa(cls,p_hPa):
-        return p_hPa*100
+    def preshPa2Pa(cls,p_hPa,out=None):
+        return np.multiply(p_hPa,100,out=out)
     @classmethod
-    def preshPa2kPa(cls,p_hPa):
-        return p_hPa/10
+    def preshPa2kPa(cls,p_hPa,out=None):
+        return np.divide(p_hPa,10,out=out)
     @classmethod
-    def preskPa2Pa(cls,p_kPa):
-        return p_kPa*1000
+    def preskPa2Pa(cls,p_kPa,out=None):
+        return np.multiply(p_kPa,1000,out=out)
     @classmethod
-    def preskPa2hPa(cls,p_kPa):
-        return p_kPa*100
+    def preskPa2hPa(cls,p_kPa,out=None):
+        return np.multiply(p_kPa,100,out=out)
     @classmethod
-    def rhfraction2procent(cls,rh):
-        return rh*100
+    def rhfraction2procent(cls,rh,out=None):
+        return np.multiply(rh,100,out=out)
     @classmethod
-    def rhprocent2fraction(cls,rh_procent):
-        return rh_procent/100
+    def rhprocent2fraction(cls,rh_procent,out=None):
+        return np.divide(rh_procent,100,out=out)
 
 class MeteoFuncs(object):
     STEFAN_BOLTZMANN = 5.67e-8
@@ -67,6 +67,16 @@ class MeteoFuncs(object):
         Returns:
             saturated vapor pressure [kPa], $e_{sat}$
         """
+        if isinstance(temp_K,np.ndarray):
+            # in place, with one temporary array
+            e_sat = np.subtract(temp_K,273.16)
+            denominator = np.subtract(temp_K,35.86)
+            e_sat /= denominator
+            del denominator
+            e_sat *= 17.2694
+            np.exp(e_sat,out=e_sat)
+            e_sat *= 0.611
+            return e_sat
         return 0.611 * np.exp(17.2694*(temp_K-273.16)/(temp_K-35.86))
     @classmethod
     def wind_speed(cls,u,v):
@@ -1,4 +1,6 @@
+import dask.array as da
 import numpy as np
+import pandas as pd
 import xarray as xr
 import tcitool
 
@@ -11,41 +13,69 @@ class CommonMeteoGenerators(object):
         gr.register(cls.ws10, 'ws10', ['u10','v10'])
         gr.register(cls.wdir10, 'wdir10', ['u10','v10'])
         gr.register(cls.ws2, 'ws2', ['ws10','fsr'])
-        gr.register(cls.ws2, 'ws2', ['u10','v10','fsr'])
 
         gr.register(cls.dewpoint, 'd2m', 'e_kPa')
-        gr.register(cls.from_rh, 'd2m', ['t2m','rh'])
+        gr.register(cls.from_rh, 'd2m', ['e_sat_kPa','rh'])
         gr.register(cls.e, 'e_kPa', 'd2m')
-        gr.register(cls.from_rh, 'e_kPa', ['t2m','rh'])
+        gr.register(cls.from_rh, 'e_kPa', ['e_sat_kPa','rh'])
         gr.register(cls.e_sat, 'e_sat_kPa', 't2m')
-        gr.register(cls.rh, 'rh', ['t2m','e_kPa'])
-        gr.register(cls.rh, 'rh', ['t2m','d2m'])
+        gr.register(cls.rh, 'rh', ['e_kPa','e_sat_kPa'])
 
         gr.register(cls.pressure_kPa, ['msl_kPa'], ['msl'])
         gr.register(cls.surf_pressure_kPa, ['sp_kPa'], ['sp'])
         gr.register(cls.pressure_Pa,  ['msl'], ['msl_kPa'])
         gr.register(cls.surf_pressure_Pa,  ['sp'], ['sp_kPa'])
 
+    @classmethod
+    def convert(cls,tool,source,target,func,attrs,drop_source=False):
+        """Stores func(tool.data[source]) as tool.data[target], with attrs
+
+        func is applied to the underlying array (np.array or lazy dask
+        array), so no intermediate DataArrays are made. The result is cast to
+        tool.options['dtype'] if set (see Tool.compute_dtype), or else the
+        float dtype of source is kept (e.g. float32 for ERA5), unless
+        tool.options['precise_conversions'] is set.
+
+        With drop_source, source is deleted from tool.data. If it is an
+        in-memory float array owned by tool.data (see DataStore.owns), it is
+        converted in place (func is called with out=), so the swap (e.g.
+        msl -> msl_kPa) needs no extra memory.
+        """
+        var = tool.data[source].variable
+        data = var.data
+        if (drop_source and tool.data.owns(source) and
+                isinstance(data,np.ndarray) and
+                data.dtype.kind=='f' and data.flags.writeable):
+            result = func(data,out=data)
+        else:
+            result = func(data)
+        dtype = tool.compute_dtype()
+        if dtype is None and not tool.options.get('precise_conversions',False):
+            dtype = data.dtype
+        if (data.dtype.kind=='f' and dtype is not None and
+                result.dtype != dtype):
+            result = result.astype(dtype,copy=False)
+        if drop_source:
+            del tool.data[source]
+        tool.data[target] = var.dims, result, attrs
+
     @classmethod
     def t2mC(cls,tool):
         """Converts the 2m temperature from K to deg C"""
-        tool.data['t2mC'] = tcitool.UnitFuncs.tempK2C(tool.data['t2m'])
-        tool.data['t2mC'].attrs = tool.data['t2m'].attrs
-        tool.data['t2mC'].attrs['units'] = 'deg C'
+        cls.convert(tool,'t2m','t2mC',tcitool.UnitFuncs.tempK2C,
+            dict(tool.data['t2m'].attrs,units='deg C'))
 
     @classmethod
     def d2mC(cls,tool):
         """Converts the 2m dew point from K to deg C"""
-        tool.data['d2mC'] = tcitool.UnitFuncs.tempK2C(tool.data['d2m'])
-        tool.data['d2mC'].attrs = tool.data['d2m'].attrs
-        tool.data['d2mC'].attrs['units'] = 'deg C'
+        cls.convert(tool,'d2m','d2mC',tcitool.UnitFuncs.tempK2C,
+            dict(tool.data['d2m'].attrs,units='deg C'))
 
     @classmethod
     def sktC(cls,tool):
         """Converts the skin temperature from K to deg C"""
-        tool.data['sktC'] = tcitool.UnitFuncs.tempK2C(tool.data['skt'])
-        tool.data['sktC'].attrs = tool.data['skt'].attrs
-        tool.data['sktC'].attrs['units'] = 'deg C'
+        cls.convert(tool,'skt','sktC',tcitool.UnitFuncs.tempK2C,
+            dict(tool.data['skt'].attrs,units='deg C'))
 
     @classmethod
     def ws10(cls,tool):
@@ -55,8 +85,6 @@ class CommonMeteoGenerators(object):
         tool.data['ws10'].attrs['long_name'] = 'Wind speed at 10 metre'
     @classmethod
     def ws2(cls,tool):
-        if 'ws10' not in tool.data and 'u10' in tool.data and 'v10' in tool.data:
-            cls.ws10(tool)
         tool.data['ws2'] = tcitool.MeteoFuncs.wind_at_height_using_fsr(
             tool.data['ws10'],
             tool.data['fsr'],
@@ -81,27 +109,17 @@ class CommonMeteoGenerators(object):
         })
     @classmethod
     def e_sat(cls,tool):
-        tool.data['e_sat_kPa'] = tcitool.MeteoFuncs.saturated_vapor_pressure(
-            tool.data['t2m'])
-        tool.data['e_sat_kPa'].attrs.update({
-            'units': 'kPa',
-            'long_name': 'Saturated vapor pressure'
-        })
+        cls.convert(tool,'t2m','e_sat_kPa',
+            tcitool.MeteoFuncs.saturated_vapor_pressure,
+            {'units': 'kPa', 'long_name': 'Saturated vapor pressure'})
     @classmethod
     def e(cls,tool):
-        tool.data['e_kPa'] = tcitool.MeteoFuncs.saturated_vapor_pressure(
-            tool.data['d2m'])
-        tool.data['e_kPa'].attrs.update({
-            'units': 'kPa',
-            'long_name': 'Vapor pressure'
-        })
+        cls.convert(tool,'d2m','e_kPa',
+            tcitool.MeteoFuncs.saturated_vapor_pressure,
+            {'units': 'kPa', 'long_name': 'Vapor pressure'})
     @classmethod
     def rh(cls,tool):
-        """Calculates relative humidity from the temperature and dew point"""
-        if 'e_sat_kPa' not in tool.data and 't2m' in tool.data:
-            cls.e_sat(tool)
-        if 'e_kPa' not in tool.data and 'd2m' in tool.data:
-            cls.e(tool)
+        """Calculates relative humidity from the (saturated) vapor pressure"""
         tool.data['rh'] = tool.data['e_kPa']/tool.data['e_sat_kPa']
         tool.data['rh'].attrs.update({
             'units': '(0 - 1)',
@@ -109,9 +127,8 @@ class CommonMeteoGenerators(object):
         })
     @classmethod
     def from_rh(cls,tool):
-        """Calculates dewpoint and vapor_pressure from temp and rh"""
-        if 'e_sat_kPa' not in tool.data and 't2m' in tool.data:
-            cls.e_sat(tool)
+        """Calculates dewpoint and vapor_pressure from the saturated vapor
+        pressure and rh"""
         tool.data['e_kPa'] = tool.data['e_sat_kPa'] * tool.data['rh']
         tool.data['e_kPa'].attrs.update({
             'units': 'kPa',
@@ -121,30 +138,26 @@ class CommonMeteoGenerators(object):
 
     @classmethod
     def pressure_kPa(cls,tool):
-        msl = tool.data['msl']/1000
-        tool.data['msl_kPa'] = msl.assign_attrs(units='kPa',
-            long_name=tool.data['msl'].attrs['long_name'])
-        tool.data.ds = tool.data.ds.drop_vars(['msl'])
+        cls.convert(tool,'msl','msl_kPa',tcitool.UnitFuncs.presPa2kPa,
+            {'units': 'kPa', 'long_name': tool.data['msl'].attrs['long_name']},
+            drop_source=True)
 
     @classmethod
     def surf_pressure_kPa(cls,tool):
-        sp = tool.data['sp']/1000
-        tool.data['sp_kPa'] = sp.assign_attrs(units='kPa',
-            long_name=tool.data['sp'].attrs['long_name'])
-        tool.data.ds = tool.data.ds.drop_vars(['sp'])
+        cls.convert(tool,'sp','sp_kPa',tcitool.UnitFuncs.presPa2kPa,
+            {'units': 'kPa', 'long_name': tool.data['sp'].attrs['long_name']},
+            drop_source=True)
 
     @classmethod
     def pressure_Pa(cls,tool):
-        msl = tool.data['msl_kPa']*1000
-        tool.data['msl'] = msl.assign_attrs(units='Pa',
-            long_name=tool.data['msl_kPa'].attrs['long_name'])
-        tool.data.ds = tool.data.ds.drop_vars(['msl_kPa'])
+        cls.convert(tool,'msl_kPa','msl',tcitool.UnitFuncs.preskPa2Pa,
+            {'units': 'Pa', 'long_name': tool.data['msl_kPa'].attrs['long_name']},
+            drop_source=True)
     @classmethod
     def surf_pressure_Pa(cls,tool):
-        sp = tool.data['sp_kPa']*1000
-        tool.data['sp'] = sp.assign_attrs(units='Pa',
-            long_name=tool.data['sp_kPa'].attrs['long_name'])
-        tool.data.ds = tool.data.ds.drop_vars(['sp_kPa'])
+        cls.convert(tool,'sp_kPa','sp',tcitool.UnitFuncs.preskPa2Pa,
+            {'units': 'Pa', 'long_name': tool.data['sp_kPa'].attrs['long_name']},
+            drop_source=True)
 
 class IntegratedVarsGenerators(object):
     @classmethod
@@ -154,23 +167,85 @@ class IntegratedVarsGenerators(object):
         gr.register(cls.Ibeam,'Ibeam','fdir','radiation_integration_time')
 
     @classmethod
-    def cumulatives2regular(cls,data,axis):
+    def cumulatives2regular(cls,data,axis,resets=None):
         """Helper-function which converts cumulative metrics to averages
 
+        Only neighbouring steps are subtracted, without copying the data first.
+        Lazy (dask) data stays lazy, and is de-cumulated per chunk, with a
+        halo of one step from the previous chunk.
+
         Args:
-            data: An np.array containing cumulative values over a certain axis
+            data: An np.array, dask array or xarray.DataArray containing
+                cumulative values over a certain axis
             axis: an interger describing the axis over which the data is
                 cumulative, usualy the time axis.
+            resets: optional 1-D boolean array along axis, True at the steps
+                where the accumulation restarted since the previous step (e.g.
+                at a new forecast base time, see accumulation_resets). There,
+                the data itself is the amount over the step.
         Returns:
-            A np.array containing the de-cumulatived data
-                (averaged over a period)
+            An array of the same type containing the de-cumulatived data
+                (averaged over a period). The first step is NaN.
         """
-        prev = np.roll(data,1,axis)
-        slices = [(slice(0,1,None)
-                   if i==axis
-                   else slice(None)) for i in range(data.ndim)]
-        prev[slices] = np.nan
-        return data-prev
+        if isinstance(data, xr.DataArray):
+            return data.copy(data=cls.cumulatives2regular(
+                data.data,axis,resets))
+        if isinstance(data, da.Array):
+            result = da.map_overlap(cls._deaccumulate,data,
+                depth={axis:(1,0)},boundary='none',axis=axis,
+                dtype=cls._deaccumulate_dtype(data.dtype))
+        else:
+            result = cls._deaccumulate(np.asarray(data),axis)
+        if resets is not None:
+            shape = [1]*data.ndim
+            shape[axis] = -1
+            resets = np.asarray(resets,dtype=bool).reshape(shape)
+            if isinstance(result, da.Array):
+                result = da.where(resets,data,result)
+            else:
+                np.copyto(result,data,where=np.broadcast_to(resets,data.shape))
+        return result
+
+    @staticmethod
+    def _deaccumulate_dtype(dtype):
+        return dtype if dtype.kind=='f' else np.dtype(np.float64)
+
+    @classmethod
+    def _deaccumulate(cls,block,axis):
+        """Subtracts the previous step from every step of the np.array block
+        along axis, the first step becomes NaN"""
+        def along(index):
+            return tuple(index if i==axis else slice(None)
+                         for i in range(block.ndim))
+        result = np.empty(block.shape,dtype=cls._deaccumulate_dtype(block.dtype))
+        np.subtract(block[along(slice(1,None))],block[along(slice(None,-1))],
+                    out=result[along(slice(1,None))])
+        result[along(slice(0,1))] = np.nan
+        return result
+
+    @classmethod
+    def accumulation_resets(cls,tool):
+        """The time steps at which accumulated variables restarted, since the
+        previous step, from tool.options['radiation_reset_hours'] (the hours
+        (UTC) of the forecast base times, e.g. [0, 12]). None if the option
+        is not set.
+
+        The value at a base time is still the last step of the previous run,
+        so the reset is at the first step after a base time."""
+        hours = tool.options.get('radiation_reset_hours')
+        if hours is None:
+            return None
+        times = pd.DatetimeIndex(tool.data.ds['time'].values)
+        days = times.floor('D')
+        last_base = None
+        for hour in hours:
+            base = days + pd.Timedelta(hours=hour)
+            base = base.where(base < times, base - pd.Timedelta(days=1))
+            last_base = (base if last_base is None
+                         else last_base.where(last_base >= base, base))
+        resets = np.zeros(len(times),dtype=bool)
+        resets[1:] = last_base[1:] >= times[:-1]
+        return resets
 
     @classmethod
     def Isw_in(cls,tool):
@@ -178,7 +253,8 @@ class IntegratedVarsGenerators(object):
         ssrd = tool.data['ssrd']
         if ('radiation_cumulative' in tool.options and
             tool.options['radiation_cumulative']):
-            ssrd = cls.cumulatives2regular(ssrd, 0)
+            ssrd = cls.cumulatives2regular(ssrd,0,
+                cls.accumulation_resets(tool))
         tool.data['Isw_in'] = ssrd/tool.options['radiation_integration_time']
         tool.data['Isw_in'].attrs = {'units':'W m**-2',
             'long_name':'Surface solar irradiation downwards'}
@@ -189,7 +265,8 @@ class IntegratedVarsGenerators(object):
         strd = tool.data['strd']
         if ('radiation_cumulative' in tool.options and
             tool.options['radiation_cumulative']):
-            strd = cls.cumulatives2regular(strd,0)
+            strd = cls.cumulatives2regular(strd,0,
+                cls.accumulation_resets(tool))
         tool.data['Ilw_in'] =  strd/tool.options['radiation_integration_time']
         tool.data['Ilw_in'].attrs = {'units':'W m**-2',
             'long_name':'Surface thermal irradiation downwards'}
@@ -200,7 +277,8 @@ class IntegratedVarsGenerators(object):
         fdir = tool.data['fdir']
         if ('radiation_cumulative' in tool.options and
             tool.options['radiation_cumulative']):
-            fdir = cls.cumulatives2regular(fdir,0)
+            fdir = cls.cumulatives2regular(fdir,0,
+                cls.accumulation_resets(tool))
         tool.data['Ibeam'] =  fdir/tool.options['radiation_integration_time']
         tool.data['Ibeam'].attrs = {'units':'W m**-2',
             'long_name':'Total sky direct solar radiation at surface'}
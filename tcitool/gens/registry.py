@@ -1,3 +1,8 @@
+import os
+
+import dask.base
+import xarray as xr
+
 import tcitool
 
 class GeneratorRegistry(object):
@@ -43,11 +48,9 @@ class GeneratorRegistry(object):
             self.generators[provides_param].append(kwargs)
 
     def find_and_run(self,param):
-        """Finds a relevant generator, to satisfy the data need, and runs it.
+        """Finds the generators needed to satisfy the data need, and runs them.
 
-        Finds a generator, that generates the parameter, where all requirements
-        are satisfied (requires and options). If multiple generators exsist, the
-        frist generator (in the order of registering) will be used.
+        See plan and run_plan.
 
         Args:
             param: string describing the data parameter needed.
@@ -57,11 +60,111 @@ class GeneratorRegistry(object):
             False if the nessesary `requires` or `options` were not pressent
             None if no generator-method could be found
         """
-        if param in self.generators:
-            for gen in self.generators[param]:
-                if (self.tool.data.has_keys(*gen['requires']) and
-                    self.tool.has_options(*gen['options'])):
-                    gen['func'](self.tool)
-                    return True
+        if param not in self.generators:
+            return None
+        steps, missing = self.plan(param)
+        if missing:
             return False
-        return None
+        self.run_plan(steps)
+        return True
+
+    def plan(self,*params):
+        """Plans the generators needed to generate all params at once.
+
+        For every missing parameter, the chain of generators with the fewest
+        steps is chosen, where the requirements of a generator may themselves
+        be generated. If multiple chains are equally short, the one with the
+        generators registered first is used. Intermediate parameters needed by
+        more than one parameter are planned (and generated) only once.
+
+        Args:
+            params: strings describing the data parameters needed.
+
+        Returns:
+            A tuple (steps, missing), with the list of generators in the order
+            they need to be run, and the list of params that can not be
+            generated.
+        """
+        steps = []
+        missing = []
+        for param in params:
+            chain = self.resolve(param,frozenset())
+            if chain is None:
+                missing.append(param)
+                continue
+            for gen in chain:
+                if not any(gen is step for step in steps):
+                    steps.append(gen)
+        return steps, missing
+
+    def resolve(self,param,visiting):
+        """The shortest list of generators (in run order) that generates
+        param, [] if param is available, or None if it can not be generated.
+        visiting contains the parameters further up the chain, to break
+        cycles (e.g. d2m <-> e_kPa)."""
+        if self.tool.data.has_keys(param):
+            return []
+        best = None
+        for gen in self.generators.get(param,[]):
+            if (not self.tool.has_options(*gen['options']) or
+                    any(req in visiting or req == param
+                        for req in gen['requires'])):
+                continue
+            chain = []
+            for req in gen['requires']:
+                subchain = self.resolve(req,visiting | {param})
+                if subchain is None:
+                    chain = None
+                    break
+                chain += [sub for sub in subchain
+                          if not any(sub is step for step in chain)]
+            if chain is None:
+                continue
+            chain.append(gen)
+            if best is None or len(chain) < len(best):
+                best = chain
+        return best
+
+    def run_plan(self,steps):
+        """Runs the generators planned by plan, in order
+
+        Generators of which all parameters were generated by an earlier step
+        are skipped. The generated parameters are marked as derived in
+        tool.data, so they may be evicted when memory is short (see
+        DataStore.evict). When tool.options['cache_dir'] is set, they are
+        cached on disk (see run_cached).
+        """
+        for gen in steps:
+            if self.tool.data.has_keys(*gen['provides']):
+                continue
+            if self.tool.options.get('cache_dir') is not None:
+                self.run_cached(gen,self.tool.options['cache_dir'])
+            else:
+                gen['func'](self.tool)
+            for provides_param in gen['provides']:
+                if provides_param in self.tool.data:
+                    self.tool.data.mark_derived(
+                        provides_param,gen['requires'])
+
+    def run_cached(self,gen,cache_dir):
+        """Runs the generator gen, unless its results are cached in cache_dir
+
+        The cache is keyed by the generator, its input variables and its
+        options. After generating, the results are written to the cache and
+        read back lazily, so they do not have to stay in memory.
+        """
+        key = dask.base.tokenize(
+            gen['func'].__qualname__,
+            [self.tool.data[req] for req in gen['requires']],
+            [self.tool.options[opt] for opt in gen['options']])
+        path = os.path.join(cache_dir,'%s-%s.nc'%('-'.join(gen['provides']),key))
+        if not os.path.isfile(path):
+            gen['func'](self.tool)
+            provides = [param for param in gen['provides']
+                        if param in self.tool.data]
+            os.makedirs(cache_dir,exist_ok=True)
+            self.tool.data.ds[provides].to_netcdf(path+'.tmp')
+            os.replace(path+'.tmp',path)
+        cached = xr.open_dataset(path,chunks={})
+        for param in cached.data_vars:
+            self.tool.data[param] = cached[param]
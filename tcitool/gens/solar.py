@@ -1,9 +1,22 @@
+import collections
+import hashlib
+import os
+
 import numpy as np
 import xarray as xr
 
 import tcitool
 
 class SolarGenerators(object):
+    """
+    Attributes:
+        cache: an OrderedDict of the solar parameters calculated last (see
+            cachedSolarParamNOAA), in least recently used order
+        cache_size: the number of grids kept in cache
+    """
+    cache = collections.OrderedDict()
+    cache_size = 8
+
     @classmethod
     def register_generators(cls,gr):
         gr.register(cls.main,
@@ -16,13 +29,74 @@ class SolarGenerators(object):
 
         Source for the calculation:
             https://www.esrl.noaa.gov/gmd/grad/solcalc/calcdetails.html
+
+        The parameters are calculated on the 1-D coordinate axes (see
+        extractCoordAxes), so the terms depending only on time are calculated
+        once per time step, and the hour angle once per (time, longitude).
+        Only the results are broadcast to the full data cube, as read-only
+        views (or lazily, if the data is chunked).
         """
-        ts, lon, lat = cls.extractCoordVars(tool.data.ds)
-        solarparam = cls.solarParamNOAA(ts,lon,lat)
+        ds = tool.data.ds
+        if any(key in ds.data_vars for key in ('ts','lon','lat')):
+            solarparam = cls.solarParamNOAA(*cls.extractCoordVars(ds))
+        else:
+            solarparam = cls.cachedSolarParamNOAA(
+                *cls.extractCoordAxes(ds),
+                cache_dir=tool.options.get('solar_cache_dir'))
+        dims = tool.data.default_order() or tuple(ds.dims)
+        chunk_size = tool.data.get_chunk_size()
         for key, array in solarparam.items():
+            array = array.broadcast_like(ds).transpose(*dims)
+            if chunk_size:
+                array = array.chunk(chunk_size)
             tool.data[key] = array
         tool.data.transpose_default()
 
+    @classmethod
+    def cachedSolarParamNOAA(cls,ts,lon,lat,cache_dir=None):
+        """solarParamNOAA for the 1-D axes ts, lon and lat, memoized by a hash
+        of their values.
+
+        The last cache_size results are kept in memory. When cache_dir is
+        given, the results are also stored there, so other Tools (e.g. other
+        ensemble members on the same grid and times) and reruns can skip the
+        calculation.
+        """
+        key = hashlib.sha1()
+        for axis in (ts.astype('datetime64[ns]'),lon,lat):
+            key.update(axis.dims[0].encode())
+            key.update(np.ascontiguousarray(axis.values).tobytes())
+        key = key.hexdigest()
+        if key in cls.cache:
+            cls.cache.move_to_end(key)
+            return cls.cache[key].copy(deep=False)
+        path = (None if cache_dir is None
+                else os.path.join(cache_dir,'solar-%s.nc'%key))
+        if path is not None and os.path.isfile(path):
+            with xr.open_dataset(path) as cached:
+                solarparam = cached.load()
+        else:
+            solarparam = cls.solarParamNOAA(ts,lon,lat)
+            if path is not None:
+                os.makedirs(cache_dir,exist_ok=True)
+                solarparam.to_netcdf(path+'.tmp')
+                os.replace(path+'.tmp',path)
+        cls.cache[key] = solarparam
+        while len(cls.cache) > cls.cache_size:
+            cls.cache.popitem(last=False)
+        return solarparam.copy(deep=False)
+
+    @classmethod
+    def extractCoordAxes(cls,ds):
+        """Returns the time, longitude and latitude coordinates of ds, as
+        1-D DataArrays along their own dimension"""
+        def get_coord_axis(coord):
+            return xr.DataArray(np.atleast_1d(ds.coords[coord].values),
+                dims=[coord],coords={coord: np.atleast_1d(ds.coords[coord].values)},
+                attrs=ds.coords[coord].attrs)
+        return (get_coord_axis('time'),get_coord_axis('longitude'),
+                get_coord_axis('latitude'))
+
     @classmethod
     def extractCoordVars(cls,ds):
         def get_coord_var(ds,coord):
@@ -37,70 +111,100 @@ class SolarGenerators(object):
 
     @classmethod
     def solarParamNOAA(cls,ts,lon,lat):
-        lon_rad = np.deg2rad(lon)
-        lon_rad.attrs = {'units':'rad','long_name': 'longitude'}
-        lat_rad = np.deg2rad(lat)
-        lat_rad.attrs = {'units':'rad','long_name': 'latitude'}
-        unix_ts = ts.astype('datetime64[s]').astype('int')
-        unix_ts.attrs = {'units':'s','long_name':'seconds since 1970-01-01'}
+        """Calculates the solar parameters for the times ts (datetime64), and
+        the longitudes lon and latitudes lat (in degrees).
+
+        The inputs are DataArrays, which are broadcast by their dimension
+        names. The calculation itself is done in numpy (see solarKernelNOAA),
+        and the results are wrapped into DataArrays once, at the end.
+
+        Returns:
+            A xarray.Dataset with soldist, solhour, solza and solazimuth
+        """
+        dims = tuple(dict.fromkeys(ts.dims+lon.dims+lat.dims))
+        sizes = {}
+        coords = {}
+        for da in (ts,lon,lat):
+            sizes.update(da.sizes)
+            for name, coord in da.coords.items():
+                coords.setdefault(name,coord)
+        def raw(da):
+            da = da.transpose(*[dim for dim in dims if dim in da.dims])
+            return np.asarray(da.values).reshape(
+                [sizes[dim] if dim in da.dims else 1 for dim in dims])
+        def wrap(array,attrs):
+            keep = [dim for dim, size in zip(dims,array.shape)
+                    if size==sizes[dim]]
+            return xr.DataArray(
+                array.reshape([sizes[dim] for dim in keep]),
+                dims=keep,
+                coords={name: coord for name, coord in coords.items()
+                        if set(coord.dims) <= set(keep)},
+                attrs=attrs)
+        unix_ts = raw(ts).astype('datetime64[s]').astype(np.int64)
+        solarparam = cls.solarKernelNOAA(unix_ts,raw(lon),raw(lat))
+        return xr.Dataset({
+            'soldist': wrap(solarparam['soldist'],
+                {'units':'au','long_name':'Sun Rad Vector'}),
+            'solhour': wrap(solarparam['solhour'],
+                {'units':'rad','long_name':'Hour Angle'}),
+            'solza': wrap(solarparam['solza'],
+                {'units':'rad','long_name':
+                    'Solar Zenith Angle corrected for atm refraction'}),
+            'solazimuth': wrap(solarparam['solazimuth'],
+                {'units':'deg CW from N','long_name':'Solar Azimuth Angle'}),
+        }).squeeze(drop=True)
+
+    @classmethod
+    def solarKernelNOAA(cls,unix_ts,lon_deg,lat_deg):
+        """The NOAA solar calculation on np.arrays
+
+        Args:
+            unix_ts: seconds since 1970-01-01
+            lon_deg: longitude in degrees
+            lat_deg: latitude in degrees
+            The arrays are broadcast against each other, e.g. with shapes
+            (time,1,1), (1,lon,1) and (1,1,lat). The terms depending only on
+            time are then calculated per time step, and the hour angle per
+            (time, lon).
+
+        Returns:
+            A dict with the np.arrays soldist (au), solhour (rad), solza (rad)
+            and solazimuth (deg CW from N). solza and solazimuth have the
+            full broadcast shape (N points), and are calculated in place: at
+            most four arrays of N floats (and a few boolean masks) are alive
+            at the same time.
+        """
         julian_day = unix_ts/86400.0 + 2440587.5
-        julian_day.attrs = {'units':'days',
-            'long_name':'days since 4713BC-01-01 12h UTC'}
         julian_century = (julian_day - 2451545) / 36525
-        julian_century.attrs = {'units':'centuries',
-            'long_name':'decimal julian centuries since 2000-01-01 12hUTC'}
         time_frac = unix_ts / 86400 % 1
-        time_frac.attrs = {'units':'days',
-            'long_name':'time of a day represented as decimal day [0-1]'}
-        long_sun_deg = ( 280.46646 + julian_century*(
-            36000.76983 + 0.0003032*julian_century )) % 360
-        long_sun_deg.attrs = {'units':'deg','long_name':'Geom Mean Long Sun'}
-        long_sun = np.deg2rad(long_sun_deg)
-        long_sun.attrs = {'units':'rad','long_name':'Geom Mean Long Sun'}
-        anom_sun_deg = 357.52911 + julian_century*(
-            35999.05029 - 0.0001537*julian_century)
-        anom_sun_deg.attrs = {'units':'deg','long_name':'Geom Mean Anom Sun'}
-        anom_sun = np.deg2rad(anom_sun_deg)
-        anom_sun.attrs = {'units':'rad','long_name':'Geom Mean Anom Sun'}
+        long_sun = np.deg2rad(( 280.46646 + julian_century*(
+            36000.76983 + 0.0003032*julian_century )) % 360)
+        anom_sun = np.deg2rad(357.52911 + julian_century*(
+            35999.05029 - 0.0001537*julian_century))
         eccent_earth_orbit = 0.016708634-julian_century*(
             0.000042037+0.0000001267*julian_century)
-        eccent_earth_orbit.attrs = {'units':'','long_name':'Eccent Earth Orbit'}
-        sun_eqofctr_deg = (
+        sun_eqofctr = np.deg2rad(
             np.sin(anom_sun) * (1.914602 -
                 julian_century * (0.004817 + 0.000014 * julian_century)) +
             np.sin(2 * anom_sun) * (0.019993 - 0.000101 * julian_century) +
             np.sin(3 * anom_sun) * 0.000289
         )
-        sun_eqofctr_deg.attrs = {'units':'deg','long_name':'Sun Eq of Ctr'}
-        sun_eqofctr = np.deg2rad(sun_eqofctr_deg)
-        sun_eqofctr.attrs = {'units':'rad','long_name':'Sun Eq of Ctr'}
         long_sun_true = long_sun + sun_eqofctr
-        long_sun_true.attrs = {'units':'rad','long_name':'Sun True Long'}
         anom_sun_true = anom_sun + sun_eqofctr
-        anom_sun_true.attrs = {'units':'rad','long_name':'Sun True Anom'}
         sun_rad_vector = (
             ( 1.000001018 * (1 - np.power(eccent_earth_orbit,2))) /
             (1+eccent_earth_orbit*np.cos(anom_sun_true))
         )
-        sun_rad_vector.attrs = {'units':'au','long_name':'Sun Rad Vector'}
+        omega = np.deg2rad(125.04 - 1934.136 * julian_century)
         sun_app_long = np.deg2rad(
-            np.rad2deg(long_sun_true) - 0.00569 - 0.00478 *
-            np.sin(np.deg2rad(125.04 - 1934.136 * julian_century)) )
-        sun_app_long.attrs = {'units':'rad','long_name':'Sun App Long'}
+            np.rad2deg(long_sun_true) - 0.00569 - 0.00478 * np.sin(omega))
         mean_obliq = np.deg2rad(23 + (26 + (21.448 - julian_century * (
                 46.815 + julian_century * (0.00059 - julian_century * 0.001813)
             )) / 60) / 60)
-        mean_obliq.attrs = {'units':'rad','long_name':'Mean Obliq Ecliptic'}
         obliq_corr = np.deg2rad(
-            np.rad2deg(mean_obliq) +
-            0.00256 * np.cos(np.deg2rad(125.04 - 1934.136 * julian_century)) )
-        obliq_corr.attrs = {'units':'rad','long_name':'Obliq Corr'}
-
-        sun_rt_ascen = np.arctan2(
-            np.cos(obliq_corr)*np.sin(sun_app_long),np.cos(sun_app_long))
-        sun_rt_ascen.attrs = {'units':'rad','long_name':'Sun Rt Ascen'}
+            np.rad2deg(mean_obliq) + 0.00256 * np.cos(omega))
         sun_declin = np.arcsin(np.sin(obliq_corr)*np.sin(sun_app_long))
-        sun_declin.attrs = {'units':'rad','long_name':'Sun Declin'}
         var_y = np.tan(obliq_corr/2)**2
         eq_of_time = 4 * np.rad2deg(
             var_y * np.sin(2*long_sun)
@@ -109,58 +213,58 @@ class SolarGenerators(object):
             - 0.5 * var_y**2 *np.sin(4*long_sun)
             - 1.25 * eccent_earth_orbit**2 * np.sin(2*anom_sun)
         )
-        eq_of_time.attrs = {'units':'min','long_name':'Eq of Time'}
-        true_solar_time = (
-            time_frac * 1440 + eq_of_time + 4 * np.rad2deg(lon_rad) ) % 1440
-        true_solar_time.attrs = {'units':'min','long_name':'True Solar Time'}
+        true_solar_time = (time_frac * 1440 + eq_of_time + 4 * lon_deg) % 1440
         hour_angle = np.deg2rad(true_solar_time/4 - 180)
-        hour_angle.attrs = {'units':'rad','long_name':'Hour Angle'}
-
-        zenith_uncorr = np.arccos(
-            np.sin(lat_rad) * np.sin(sun_declin)
-             + np.cos(lat_rad) * np.cos(sun_declin)*np.cos(hour_angle) )
-        zenith_uncorr.attrs = {'units':'rad','long_name':'Solar Zenith Angle'}
-        elevation = np.deg2rad(90 - np.rad2deg(zenith_uncorr))
-        elevation.attrs = {'units':'rad',
-            'long_name':'Solar Elevation Angle'}
-
-        atmospheric_refraction = np.deg2rad(
-            xr.where(elevation>np.deg2rad(85),0,
-            xr.where(elevation>np.deg2rad(5),(
-                58.1 / np.tan(elevation)
-                - 0.07 / np.power(np.tan(elevation),3)
-                + 8.6e-5 / np.power(np.tan(elevation),5) ),
-            xr.where(elevation>np.deg2rad(-0.575),(
-                1735 + elevation * (
-                    -518.2 + elevation * (
-                        103.4 + elevation * (
-                        -12.79 + elevation*0.711)))),
-                -20.772/np.tan(elevation)
-            ))) / 3600)
-        atmospheric_refraction.attrs = {'units':'rad',
-            'long_name':'Approx Atmospheric Refraction'}
-        elevation_corr = elevation + atmospheric_refraction
-        elevation_corr.attrs = {'units':'rad',
-            'long_name':'Solar Elevation corrected for atm refraction'}
-        zenith = np.deg2rad(90)-elevation_corr
-        zenith.attrs = {'units':'rad',
-            'long_name':'Solar Zenith Angle corrected for atm refraction'}
-
-        azimuth_arccos = np.arccos( ( (
-                (np.sin(lat_rad) * np.cos(zenith_uncorr) - np.sin(sun_declin))
-                / (np.cos(lat_rad) * np.sin(zenith_uncorr))
-                + 1)
-            % 2) - 1)
-        azimuth = (xr.where(
-            hour_angle>0,
-            np.rad2deg(azimuth_arccos)+180,
-            540 - np.rad2deg(azimuth_arccos)
-        ) % 360)
-        azimuth.attrs = {'units':'deg CW from N',
-            'long_name':'Solar Azimuth Angle'}
-        return xr.Dataset({
+
+        lat_rad = np.deg2rad(lat_deg)
+        sin_lat, cos_lat = np.sin(lat_rad), np.cos(lat_rad)
+        sin_declin = np.sin(sun_declin)
+        # zenith (uncorrected for refraction)
+        zenith = np.multiply(np.cos(hour_angle),cos_lat*np.cos(sun_declin))
+        zenith += sin_lat*sin_declin
+        np.clip(zenith,-1,1,out=zenith)
+        np.arccos(zenith,out=zenith)
+
+        # azimuth, from the uncorrected zenith
+        azimuth = np.cos(zenith)
+        azimuth *= sin_lat
+        azimuth -= sin_declin
+        buf = np.sin(zenith)
+        buf *= cos_lat
+        azimuth /= buf
+        azimuth += 1
+        azimuth %= 2
+        azimuth -= 1
+        np.arccos(azimuth,out=azimuth)
+        np.rad2deg(azimuth,out=azimuth)
+        azimuth += 180
+        np.subtract(720,azimuth,out=azimuth,
+                    where=np.broadcast_to(hour_angle<=0,azimuth.shape))
+        azimuth %= 360
+
+        # atmospheric refraction (in buf), at the elevation (in elevation)
+        elevation = np.subtract(np.pi/2,zenith,out=buf)
+        refraction = np.zeros_like(zenith)
+        mask = (elevation>np.deg2rad(5)) & (elevation<=np.deg2rad(85))
+        tan_elevation = np.tan(elevation[mask])
+        refraction[mask] = (58.1 / tan_elevation
+                            - 0.07 / np.power(tan_elevation,3)
+                            + 8.6e-5 / np.power(tan_elevation,5))
+        mask = (elevation>np.deg2rad(-0.575)) & (elevation<=np.deg2rad(5))
+        low = elevation[mask]
+        refraction[mask] = 1735 + low * (
+            -518.2 + low * (103.4 + low * (-12.79 + low*0.711)))
+        mask = elevation<=np.deg2rad(-0.575)
+        refraction[mask] = -20.772/np.tan(elevation[mask])
+        del mask, tan_elevation, low, elevation, buf
+        refraction /= 3600
+        np.deg2rad(refraction,out=refraction)
+        zenith -= refraction
+        del refraction
+
+        return {
             'soldist': sun_rad_vector,
             'solhour': hour_angle,
             'solza': zenith,
             'solazimuth': azimuth,
-        }).squeeze(drop=True)
+        }
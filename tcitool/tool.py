@@ -4,6 +4,7 @@ from contextlib import suppress
 import glob
 import os
 import tempfile
+import time
 import warnings
 
 import numpy as np
@@ -22,6 +23,7 @@ class Tool(object):
         self.calculators = {
             'wbgt_acsm': tcitool.WBGTapprox_ACSMCalculator,
             'wbgt_argonne': tcitool.WBGT_ArgonneCalculator,
+            'wbgt_argonne_lut': tcitool.WBGT_ArgonneLUTCalculator,
             'wbgt_bernard': tcitool.WBGTapprox_BernardCalculator,
             'wbgt_dimiceli': tcitool.WBGTapprox_DimiceliCalculator,
             'wbgt_gommers': tcitool.WBGTapprox_GommersCalculator,
@@ -29,6 +31,8 @@ class Tool(object):
             'windchill_jagti': tcitool.WindChill_JAGTICalculator,
         }
         self.options = {}
+        self.intermediates = None
+        self.pending_exports = None
         self.tmp_dir = None
         self.dask_client = dask_client
         self._selfassert()
@@ -40,15 +44,17 @@ class Tool(object):
                 calc_name)
 
     def require_data(self,*args,operation_name=""):
-        missing_params = {}
-        for param in args:
-            if not param in self.data:
-                r = self.generator_registry.find_and_run(param)
-                if r is None:
-                    missing_params[param] = []
-                if r is False:
-                    missing_params[param] = (
-                        self.generator_registry.generators[param])
+        steps, missing = self.generator_registry.plan(*args)
+        self.generator_registry.run_plan(steps)
+        dtype = self.compute_dtype()
+        if dtype is not None:
+            for param in args:
+                if (param in self.data.ds.data_vars and
+                        self.data[param].dtype.kind=='f' and
+                        self.data[param].dtype != dtype):
+                    self.data[param] = self.data[param].astype(dtype)
+        missing_params = {param: self.generator_registry.generators.get(param,[])
+                          for param in missing}
         if len(missing_params) > 0:
             msg = (
                 "The following parameters are nessesary to preform " +
@@ -71,19 +77,64 @@ class Tool(object):
     def has_options(self,*args):
         return all(map(lambda opt: opt in self.options,args))
 
-    def calculate(self,*args,calculate_now = True, squeeze=True):
+    def compute_dtype(self,default=None):
+        """The float dtype to calculate in, from tool.options['dtype'] (e.g.
+        'float32'), or default if the option is not set.
+
+        When set, the parameters required by calculators, the generated
+        parameters and the results are cast to this dtype."""
+        dtype = self.options.get('dtype',default)
+        return None if dtype is None else np.dtype(dtype)
+
+    def calculate(self,*args,calculate_now = True, squeeze=True, fused=False):
+        """Runs the calculators named in args
+
+        Args:
+            args: names of calculators (see list_calculators)
+            calculate_now: if True, the results are computed and kept in
+                memory (see DataStore.persist). Inputs opened lazily stay
+                lazy.
+            squeeze: if True and only one calculator is given, that
+                calculator is returned instead of a dict
+            fused: if True, all calculators are run in one pass. Intermediate
+                results (e.g. t2mC) are shared between the calculators, the
+                results are merged into tool.data once, and lazy data is
+                computed in a single sweep over the inputs.
+
+        Returns:
+            A dict of the names to the calculator objects (or None, if the
+            calculator could not be found)
+        """
         calculator_objs = {}
         missing_calculators = []
-        for calc_name in args:
-            if calc_name in self.calculators:
-                calc_obj = self.calculators[calc_name](self)
-                calc_obj.run()
-                if calculate_now:
-                    self.data.persist()
-                calculator_objs[calc_name] = calc_obj
-            else:
-                missing_calculators.append(calc_name)
-                calculator_objs[calc_name] = None
+        if fused:
+            self.intermediates = {}
+            self.pending_exports = []
+        try:
+            for calc_name in args:
+                if calc_name in self.calculators:
+                    calc_obj = self.calculators[calc_name](self)
+                    calc_obj.run()
+                    if calculate_now and not fused:
+                        self.data.persist(
+                            list(calc_obj.export_params.values()),
+                            self.options.get('memory_budget'))
+                    calculator_objs[calc_name] = calc_obj
+                else:
+                    missing_calculators.append(calc_name)
+                    calculator_objs[calc_name] = None
+            if fused:
+                for export_ds in self.pending_exports:
+                    self.data.assign_variables(export_ds)
+        finally:
+            self.intermediates = None
+            self.pending_exports = None
+        if fused and calculate_now:
+            self.data.persist(
+                [name for calc_obj in calculator_objs.values()
+                 if calc_obj is not None
+                 for name in calc_obj.export_params.values()],
+                self.options.get('memory_budget'))
         if len(missing_calculators) > 0:
             warning_msg = ('The calculator(s) [%s] could not be found.\n'
                 'Available calculators are [%s].')
@@ -96,38 +147,74 @@ class Tool(object):
         else:
             return calculator_objs
 
+    def precision_report(self,*args,dtypes=('float64','float32')):
+        """Runs the calculators in args once for every compute dtype (see
+        compute_dtype), in a new Tool with the same data (which is not
+        modified, see DataStore.owns), and prints for every result the time
+        its calculator took, its size and its maximum absolute difference
+        with the result of the first dtype.
+
+        The calculators are run (and computed) one by one, in the order of
+        args, so the time of a calculator includes generating the parameters
+        it is the first to require.
+
+        Returns:
+            A dict of (result name, dtype) to the result DataArray
+        """
+        results = {}
+        timings = {}
+        for dtype in dtypes:
+            tool = Tool(self.dask_client)
+            tool.options = dict(self.options,dtype=dtype)
+            tool.data.load(self.data.ds)
+            for calc_name in args:
+                start = time.perf_counter()
+                calc = tool.calculate(calc_name)
+                duration = time.perf_counter()-start
+                if calc is None:
+                    continue
+                for name in calc.export_params.values():
+                    results[(name,dtype)] = tool.data[name]
+                    timings[(name,dtype)] = duration
+
+        print('%-16s %-8s %10s %10s %12s'%(
+            'Result','dtype','Time [s]','Size [MiB]','Max abs diff'))
+        for name in dict.fromkeys(name for name, _ in results):
+            reference = results[(name,dtypes[0])]
+            for dtype in dtypes:
+                result = results[(name,dtype)]
+                diff = float(np.abs(result.astype(float) -
+                                    reference.astype(float)).max())
+                print('%-16s %-8s %10.2f %10.1f %12.2e'%(
+                    name,dtype,timings[(name,dtype)],result.nbytes/2**20,
+                    diff))
+        return results
+
     def list_calculators(self):
         return list(self.calculators.keys())
 
     def solzaLight(self):
-        solards = self.data.ds.sel(latitude=self.data.ds['latitude'].mean(),method='nearest')[['time','longitude','latitude']]
-        solards = solards.expand_dims(dim='latitude')
-        solarparam = tcitool.SolarGenerators.solarParamNOAA(*tcitool.SolarGenerators.extractCoordVars(solards))
-        for key, array in solarparam.items():
-            solards[key] = array
-        solards = solards.transpose('time','longitude','latitude')
-        for key in solards.keys():
-            data = solards[key].values
-            if 'latitude' in solards[key].coords.keys():
-                data = np.repeat(
-                    data,
-                    self.data.ds['latitude'].size,
-                    axis=list(solards[key].coords.keys()).index('latitude'))
-                self.data.ds[key] = solards[key].dims, data, solards[key].attrs
-            else:
-                solarda = solards[key].expand_dims(
-                    dim={'latitude':self.data.ds.coords['latitude'].values}
-                    ).transpose('time','longitude','latitude')
-                self.data.ds[key] = solarda.dims, solarda.values, solards[key].attrs
-
-    def wbgt_argonne_external(self,folder=None,verbose=True):
+        """Generates the solar parameters (see SolarGenerators.main), which
+        calculates them on the time/longitude/latitude axes before
+        broadcasting, instead of at the mean latitude only."""
+        tcitool.SolarGenerators.main(self)
+
+    def wbgt_argonne_external(self,folder=None,verbose=True,shard_size=1):
+        """Writes the input of the Argonne model to folder, to be solved by the
+        external argonne.py script.
+
+        The input parameters are written once, to the memory-mapped array
+        input.npy (parameters along axis 0). The script writes its results
+        in place into output.npy (Tg and Tnw along axis 0). The shards are
+        ranges of shard_size time steps of these arrays, listed in
+        manifest.txt and run_argonne_model.sh. The results are read with
+        wbgt_argonne_external_import.
+        """
         if folder is None:
             folder = tempfile.mkdtemp(prefix='tcitool-')
         folder = os.path.abspath(folder)
         with suppress(FileExistsError):
             os.makedirs(folder, exist_ok=True)
-            os.makedirs(os.path.join(folder,'inp'), exist_ok=True)
-            os.makedirs(os.path.join(folder,'out'), exist_ok=True)
         if not os.path.isdir(folder):
             raise ValueError('Dir %s does not exsist and could not be created'%folder)
         self.tmp_dir = folder
@@ -137,38 +224,60 @@ class Tool(object):
             '..',
             'argonne.py'))
         shloc = os.path.join(folder,'run_argonne_model.sh')
+        manifestloc = os.path.join(folder,'manifest.txt')
+        inpfile = os.path.join(folder,'input.npy')
+        outfile = os.path.join(folder,'output.npy')
+        jobs = []
         if not os.path.isfile(scriptloc):
             raise ValueError('Could not find argonne.py')
 
         calc = self.calculators['wbgt_argonne'](self)
         calc.preface()
-        datastack = np.stack([calc.data[key].values for key in calc.data.keys()],axis=0)
-        np.save(os.path.join(folder,'full_input.npy'),datastack)
-        for i in range(datastack.shape[1]):
-            inpfile = os.path.join(folder,'inp','%04d.npy'%i)
-            np.save(inpfile,datastack[:,i,...])
-
-            outfile = os.path.join(folder,'out','%04d.npy'%i)
-            verbose = ' -v' if verbose is True else ''
-            cmdstr.append(f'{scriptloc} -i {inpfile} -o {outfile} -p {i:04d}{verbose}')
+        nparams = len(calc.optimize_params().keys())
+        shape = calc.data['t2m'].shape
+        inp = np.lib.format.open_memmap(inpfile,mode='w+',dtype=calc.dtype,
+            shape=(nparams,)+shape)
+        calc.optimize_stack(out=inp)
+        inp.flush()
+        out = np.lib.format.open_memmap(outfile,mode='w+',dtype=calc.dtype,
+            shape=(2,)+shape)
+        out[...] = np.nan
+        out.flush()
+        del inp, out
+
+        verbose = ' -v' if verbose is True else ''
+        for start in range(0,shape[0],shard_size):
+            stop = min(start+shard_size,shape[0])
+            cmdstr.append(f'{scriptloc} -i {inpfile} -o {outfile} -r {start}:{stop} -p {start:04d}{verbose}')
+            jobs.append(f'{inpfile} {outfile} {start:04d} {start}:{stop}')
         with open(shloc,'w') as fh:
             fh.write('\n'.join(cmdstr))
+        with open(manifestloc,'w') as fh:
+            fh.write('\n'.join(jobs))
         print(f'Written data to {folder}\nRun the following command to run the Argonne model over the data.')
+        print(f'\n$ {scriptloc} -m {manifestloc} -j 4{verbose}')
+        print(f'\nor, to run every shard in a separate process,')
         print(f'\n$ parallel -j 4 :::: {shloc}')
 
     def wbgt_argonne_external_import(self,folder=None):
+        """Reads the results of the external Argonne model from folder (see
+        wbgt_argonne_external). The memory-mapped output.npy is used without
+        copying it, older folders with one out/*.npy per time step are
+        stacked."""
         if folder is None:
-            folder = self.temp_dir
+            folder = self.tmp_dir
         folder = os.path.abspath(folder)
         if not os.path.isdir(folder):
             raise ValueError('Dir %s does not exsist.'%folder)
-        data_array = []
-        data_files = sorted(glob.glob(os.path.join(folder,'*.npy')))
-        for file in data_files:
-            file_array = np.load(file)
-            data_array.append(file_array)
-            #print(file,file_array.shape)
-        ar = np.stack(data_array,axis=1)
+        if os.path.isfile(os.path.join(folder,'output.npy')):
+            ar = np.load(os.path.join(folder,'output.npy'),mmap_mode='r')
+        else:
+            data_array = []
+            data_files = sorted(glob.glob(os.path.join(folder,'out','*.npy')))
+            for file in data_files:
+                file_array = np.load(file)
+                data_array.append(file_array)
+            ar = np.stack(data_array,axis=1)
         print('Combined',ar.shape)
         if ar.shape[0] < 2:
             raise ValueError('The first dimension needs to contain at least 2 parameters: Tg, Tnw. '+str(ar.shape))
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import tcitool
+
+def make_dataset(ntime=4):
+    return xr.Dataset(
+        {'t2m': (('time','longitude','latitude'),
+                 np.random.default_rng(0).uniform(270,300,(ntime,3,2)))},
+        coords={'time': pd.date_range('2020-01-01',periods=ntime,freq='h'),
+                'longitude': [4.0,5.0,6.0],
+                'latitude': [51.0,52.0]})
+
+def test_save_zarr_append(tmp_path):
+    pytest.importorskip('zarr')
+    ds = make_dataset()
+    store = str(tmp_path/'data.zarr')
+    tcitool.DataStore(ds.isel(time=slice(0,2))).save(
+        store,complevel=3,verbose=False)
+    tcitool.DataStore(ds.isel(time=slice(2,4))).save(
+        store,append_dim='time',complevel=3,verbose=False)
+    with xr.open_zarr(store) as saved:
+        xr.testing.assert_identical(saved.load(),ds)
+
+def test_persist_evicts_dask_variables():
+    pytest.importorskip('dask')
+    datastore = tcitool.DataStore(make_dataset().chunk({'time': 2}))
+    datastore['t2mC'] = datastore['t2m'] - 273.15
+    datastore.mark_derived('t2mC',['t2m'])
+    datastore.persist(memory_budget=1)
+    assert 't2mC' not in datastore
+    assert 't2m' in datastore
+    assert len(datastore.derived) == 0
+
+def test_assign_variables_fewer_dimensions():
+    datastore = tcitool.DataStore(make_dataset())
+    export = datastore.copy_empty()
+    export['t2m_mean'] = datastore['t2m'].mean('time').transpose(
+        'latitude','longitude')
+    datastore.assign_variables(export)
+    assert datastore['t2m_mean'].dims == ('longitude','latitude')
+    np.testing.assert_allclose(datastore['t2m_mean'],
+                               datastore['t2m'].mean('time'))
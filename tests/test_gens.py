@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import tcitool
+
+def forecast_runs(times,hours):
+    """A constant 1 unit/h, accumulated since the last forecast base time
+    before every time step"""
+    accumulated = np.empty(len(times))
+    for i, t in enumerate(times):
+        bases = [t.floor('D') + pd.Timedelta(hours=hour-24*day)
+                 for day in (0,1) for hour in hours]
+        last_base = max(base for base in bases if base < t)
+        accumulated[i] = (t-last_base)/pd.Timedelta(hours=1)
+    return accumulated
+
+@pytest.mark.parametrize('chunked',[False,True])
+def test_deaccumulate_forecast_runs(chunked):
+    times = pd.date_range('2020-01-01 03:00',periods=60,freq='h')
+    accumulated = forecast_runs(times,[0,12])
+    ds = xr.Dataset({'ssrd': (('time','longitude','latitude'),
+                              np.broadcast_to(accumulated[:,None,None],
+                                              (len(times),2,2)).copy())},
+                    coords={'time': times,'longitude': [4.0,5.0],
+                            'latitude': [51.0,52.0]})
+    if chunked:
+        pytest.importorskip('dask')
+        ds = ds.chunk({'time': 7})
+    tool = tcitool.Tool()
+    tool.options['radiation_reset_hours'] = [0,12]
+    tool.data.load(ds)
+    gens = tcitool.IntegratedVarsGenerators
+    regular = gens.cumulatives2regular(tool.data['ssrd'],0,
+                                       gens.accumulation_resets(tool))
+    regular = np.asarray(regular)
+    assert np.isnan(regular[0]).all()
+    np.testing.assert_allclose(regular[1:],1)
+
+def test_pressure_swaps_keep_loaded_dataset():
+    shape = (3,2,2)
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset({'msl': (('time','longitude','latitude'),
+                             rng.uniform(99000,103000,shape)),
+                     'sp': (('time','longitude','latitude'),
+                            rng.uniform(95000,103000,shape))},
+                    coords={'time': pd.date_range('2020-01-01',periods=3,
+                                                  freq='h'),
+                            'longitude': [4.0,5.0],'latitude': [51.0,52.0]})
+    ds['msl'].attrs = {'units': 'Pa','long_name': 'Mean sea level pressure'}
+    ds['sp'].attrs = {'units': 'Pa','long_name': 'Surface pressure'}
+    original = ds.copy(deep=True)
+    tool = tcitool.Tool()
+    tool.data.load(ds)
+    tool.require_data('msl_kPa','sp_kPa')
+    xr.testing.assert_identical(ds,original)
+    np.testing.assert_allclose(tool.data['msl_kPa'],original['msl']/1000)
+    np.testing.assert_allclose(tool.data['sp_kPa'],original['sp']/1000)
+    tool.require_data('msl','sp')
+    xr.testing.assert_identical(ds,original)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import tcitool
+
+def era5_dataset(ntime=4):
+    rng = np.random.default_rng(0)
+    shape = (ntime,2,2)
+    def field(low,high,units,long_name):
+        return (('time','longitude','latitude'),rng.uniform(low,high,shape),
+                {'units': units,'long_name': long_name})
+    return xr.Dataset(
+        {'t2m': field(290,300,'K','2 metre temperature'),
+         'd2m': field(280,288,'K','2 metre dewpoint temperature'),
+         'skt': field(290,305,'K','Skin temperature'),
+         'msl': field(100000,102000,'Pa','Mean sea level pressure'),
+         'u10': field(-5,5,'m s**-1','10 metre U wind component'),
+         'v10': field(-5,5,'m s**-1','10 metre V wind component'),
+         'fsr': field(0.1,0.5,'m','Forecast surface roughness'),
+         'ssrd': field(1e6,2e6,'J m**-2','Surface solar radiation downwards'),
+         'fdir': field(5e5,1e6,'J m**-2',
+                       'Total sky direct solar radiation at surface'),
+         'fal': field(0.1,0.3,'(0 - 1)','Forecast albedo')},
+        coords={'time': pd.date_range('2020-07-01 10:00',periods=ntime,
+                                      freq='h'),
+                'longitude': [4.0,5.0],'latitude': [51.0,52.0]})
+
+def make_tool(ds):
+    tool = tcitool.Tool()
+    tool.options['radiation_integration_time'] = 3600
+    tool.data.load(ds)
+    return tool
+
+def test_argonne_after_eviction():
+    tool = make_tool(era5_dataset())
+    tool.options['memory_budget'] = 1
+    tool.calculate('wbgt_gommers')
+    tool.calculate('wbgt_argonne')
+    assert 'wbgt_argonne' in tool.data
+
+def in_memory(var):
+    graph = dict(var.data.__dask_graph__())
+    return all(isinstance(chunk, np.ndarray) for chunk in graph.values())
+
+def test_calculate_keeps_inputs_lazy(tmp_path):
+    path = str(tmp_path/'era5.nc')
+    era5_dataset().to_netcdf(path)
+    tool = tcitool.Tool()
+    tool.data.load(path,lazy=True,verbose=False)
+    tool.calculate('wbgt_dimiceli')
+    assert in_memory(tool.data['wbgt_dimiceli'])
+    for key in ('t2m','d2m','u10','ssrd'):
+        assert tool.data[key].chunks is not None
+        assert not in_memory(tool.data[key])